@@ -0,0 +1,312 @@
+import argparse
+import csv
+import json
+import os
+import pickle
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from itertools import product
+from random import Random
+
+from classifiers import ID3, get_feature_importances, random_forest, random_forest_classify
+from instrumentation import get_peak_rss
+from utilities import get_dataset
+
+
+# Functions measured by each benchmark case, in the order in which they are run
+STAGES = ["get_dataset", "ID3", "random_forest", "random_forest_classify", "get_feature_importances"]
+# Measures compared against the baseline (the higher, the worse)
+_MEASURES = ["seconds", "peak_traced_kb", "peak_rss_kb"]
+
+
+# PUBLIC FUNCTIONS
+def generate_dataset(filename, n_of_rows, n_of_columns, cardinality, n_of_classes, noise=0.0,
+                     seed=None):
+    """
+    Write a synthetic CSV dataset of categorical attributes, whose label depends on the first
+    attributes
+
+    Parameters:
+        - filename: name of the file where the dataset has to be written (String)
+        - n_of_rows: the number of instances (int)
+        - n_of_columns: the number of attributes, label excluded (int)
+        - cardinality: the number of distinct values of each attribute (int)
+        - n_of_classes: the number of distinct labels (int)
+        - noise: the fraction of instances whose label is drawn at random, default to 0.0 (number)
+        - seed: the number used to initialize the random number generator, default to None (int)
+    """
+    random_state = Random(seed)
+    # The label is a function of (at most) three attributes, so the trees have something to learn
+    n_of_informative_columns = min(3, n_of_columns)
+    with open(filename, "w", newline="") as csv_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(["a" + str(index) for index in range(n_of_columns)] + ["label"])
+        for _ in range(n_of_rows):
+            codes = [random_state.randrange(cardinality) for _ in range(n_of_columns)]
+            if random_state.random() < noise:
+                label = random_state.randrange(n_of_classes)
+            else:
+                label = sum(codes[:n_of_informative_columns]) % n_of_classes
+            csv_writer.writerow(["v" + str(code) for code in codes] + ["c" + str(label)])
+
+def run_case(parameters, trace_memory=False):
+    """
+    Return the time or the peak memory usage of each stage of a benchmark case, measured in the
+    current process ({String: {String: number}})
+
+    The peak memory usage of a stage is the highest amount of memory allocated by Python since the
+    stage started, traced by tracemalloc, so it does not include the memory held by the previous
+    stages (nor the memory of the worker processes). Tracing slows down every allocation, so the
+    time and the memory are measured by separate runs.
+
+    Parameters:
+        - parameters: the parameters of the case, including the name of the CSV file ({String:
+          value})
+        - trace_memory: whether the peak memory usage has to be measured instead of the time,
+          default to False (bool)
+    """
+    results = {}
+    # These functions should not be used outside the scope of the parent function
+    def _measure(stage, function, *args, **kwargs):
+        if trace_memory:
+            # Only the allocations made since the start of the stage are traced
+            tracemalloc.start()
+            try:
+                value = function(*args, **kwargs)
+                results[stage] = {"peak_traced_kb": tracemalloc.get_traced_memory()[1] // 1024}
+            finally:
+                tracemalloc.stop()
+            return value
+        start = time.perf_counter()
+        value = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        results[stage] = {"seconds": seconds,
+                          "rows_per_second": parameters["rows"]/seconds if seconds > 0 else None}
+        return value
+    state = {}
+    for stage in STAGES:
+        _measure(stage, _run_stage, stage, parameters, state)
+    return results
+
+def run_stage(parameters, stage, state_filename):
+    """
+    Return the peak resident set size of a stage of a benchmark case, run in the current process
+    ({String: {String: number}})
+
+    The process is meant to run only this stage: its inputs (the datasets and the forest) are
+    loaded from the state file written by the previous stages, and its outputs are added to it.
+    The peak is the one of the process plus the largest one of its worker processes, so it
+    includes the interpreter and the inputs of the stage, but not the memory of the other stages.
+
+    Parameters:
+        - parameters: the parameters of the case, including the name of the CSV file ({String:
+          value})
+        - stage: the name of the stage, one of STAGES (String)
+        - state_filename: name of the file that contains the outputs of the previous stages
+          (String)
+    """
+    state = {}
+    if os.path.exists(state_filename):
+        with open(state_filename, "rb") as state_file:
+            state = pickle.load(state_file)
+    _run_stage(stage, parameters, state)
+    peak_rss = get_peak_rss(include_children=True)
+    with open(state_filename, "wb") as state_file:
+        pickle.dump(state, state_file)
+    return {stage: {"peak_rss_kb": peak_rss}}
+
+def run_benchmarks(cases, directory):
+    """
+    Return the results of the benchmark cases, each one run in its own processes (one measures the
+    time, one traces the memory, and one for each stage measures its peak resident set size) so
+    that it is not affected by the other ones (list of dicts)
+
+    Parameters:
+        - cases: the parameters of the cases (list of {String: value})
+        - directory: the directory where the synthetic datasets are written (String)
+    """
+    results = []
+    for index, parameters in enumerate(cases):
+        filename = os.path.join(directory, "case{}.csv".format(index))
+        generate_dataset(filename, parameters["rows"], parameters["columns"],
+                         parameters["cardinality"], parameters["classes"], parameters["noise"],
+                         parameters["seed"])
+        state_filename = os.path.join(directory, "case{}.pickle".format(index))
+        case_results = {}
+        for options in [[], ["--trace-memory"]] + [["--stage", stage, "--state", state_filename]
+                                                    for stage in STAGES]:
+            process = subprocess.run([sys.executable, os.path.abspath(__file__), "--case",
+                                      json.dumps(dict(parameters, filename=filename))] + options,
+                                     stdout=subprocess.PIPE, check=True, universal_newlines=True)
+            for stage, measures in json.loads(process.stdout).items():
+                case_results.setdefault(stage, {}).update(measures)
+        os.remove(filename)
+        os.remove(state_filename)
+        results.append({"parameters": parameters, "results": case_results})
+        print(_format_case(parameters), file=sys.stderr)
+    return results
+
+def compare_results(results, baseline, tolerance):
+    """
+    Return the regressions of the results with respect to the baseline: the measures that grew by
+    more than the tolerance, for the cases that have the same parameters (list of dicts)
+
+    Parameters:
+        - results: the cases of the current run, as returned by run_benchmarks (list of dicts)
+        - baseline: the cases of the baseline run (list of dicts)
+        - tolerance: the maximum allowed relative growth of a measure (number)
+    """
+    baseline_cases = {_get_case_key(case["parameters"]): case["results"] for case in baseline}
+    regressions = []
+    for case in results:
+        baseline_results = baseline_cases.get(_get_case_key(case["parameters"]))
+        if baseline_results is None:
+            continue
+        for stage, measures in case["results"].items():
+            for measure in _MEASURES:
+                value = measures.get(measure)
+                baseline_value = baseline_results.get(stage, {}).get(measure)
+                if not value or not baseline_value:
+                    continue
+                change = (value - baseline_value)/baseline_value
+                if change > tolerance:
+                    regressions.append({"parameters": case["parameters"], "stage": stage,
+                                        "measure": measure, "baseline": baseline_value,
+                                        "value": value, "change": change})
+    return regressions
+
+
+# PRIVATE FUNCTIONS
+# These functions should not be used outside the module
+def _run_stage(stage, parameters, state):
+    """
+    Run a stage of a benchmark case, taking its inputs from the state and adding its outputs to it
+
+    Parameters:
+        - stage: the name of the stage, one of STAGES (String)
+        - parameters: the parameters of the case, including the name of the CSV file ({String:
+          value})
+        - state: the outputs of the previous stages ({String: value})
+    """
+    if stage == "get_dataset":
+        state["train_dataset"], state["test_dataset"] = get_dataset(
+            parameters["filename"], "label", parameters["training_fraction"], parameters["seed"],
+            cache=False)
+    elif stage == "ID3":
+        ID3(state["train_dataset"], parameters["max_features"])
+    elif stage == "random_forest":
+        state["forest"] = random_forest(state["train_dataset"], parameters["trees"],
+                                        parameters["max_features"], parameters["jobs"],
+                                        parameters["seed"])
+    elif stage == "random_forest_classify":
+        random_forest_classify(state["forest"], state["test_dataset"])
+    else:
+        get_feature_importances(state["forest"])
+
+def _get_case_key(parameters):
+    """
+    Return a hashable key that identifies the parameters of a case (tuple)
+
+    Parameters:
+        - parameters: the parameters of the case ({String: value})
+    """
+    return tuple(sorted(parameters.items()))
+
+def _format_case(parameters):
+    """
+    Return a short description of the parameters of a case (String)
+
+    Parameters:
+        - parameters: the parameters of the case ({String: value})
+    """
+    return " ".join("{}={}".format(name, value) for name, value in sorted(parameters.items()))
+
+def _parse_list(parse):
+    """
+    Return a function that parses a comma separated list of values (function)
+
+    Parameters:
+        - parse: the function that parses a single value (function)
+    """
+    return lambda text: [parse(value) for value in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the library on synthetic categorical datasets. Every comma separated list defines a sweep: a case is run for each combination of values.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-r", "--rows", type=_parse_list(int), default=[1000, 10000],
+                        help="Number of instances of the datasets", dest="rows")
+    parser.add_argument("-c", "--columns", type=_parse_list(int), default=[10],
+                        help="Number of attributes of the datasets", dest="columns")
+    parser.add_argument("-k", "--cardinality", type=_parse_list(int), default=[5],
+                        help="Number of distinct values of each attribute", dest="cardinality")
+    parser.add_argument("-nc", "--classes", type=_parse_list(int), default=[3],
+                        help="Number of distinct labels", dest="classes")
+    parser.add_argument("-n", "--noise", type=_parse_list(float), default=[0.1],
+                        help="Fraction of instances whose label is drawn at random", dest="noise")
+    parser.add_argument("-nt", "--number-of-trees", type=_parse_list(int), default=[10],
+                        help="Number of trees of the forests", dest="trees")
+    parser.add_argument("-f", "--features", type=int, default=None,
+                        help="Number of features to consider when looking for the best split",
+                        dest="max_features")
+    parser.add_argument("-j", "--jobs", type=_parse_list(int), default=[1],
+                        help="Number of processes used to train the forests", dest="jobs")
+    parser.add_argument("-tf", "--training-fraction", type=float, default=0.8,
+                        help="The fraction of records reserved for the training dataset",
+                        dest="training_fraction")
+    parser.add_argument("-s", "--seed", type=int, default=0,
+                        help="Number used to generate the datasets and to train the classifiers",
+                        dest="seed")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Path of the JSON file where the results have to be saved (default: standard output)",
+                        dest="output")
+    parser.add_argument("-b", "--baseline", default=None,
+                        help="Path of the JSON file of a previous run to compare the results with",
+                        dest="baseline")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.1,
+                        help="Relative growth of time or peak memory reported as a regression",
+                        dest="tolerance")
+    parser.add_argument("--case", default=None, help=argparse.SUPPRESS, dest="case")
+    parser.add_argument("--trace-memory", action="store_true", help=argparse.SUPPRESS,
+                        dest="trace_memory")
+    parser.add_argument("--stage", default=None, help=argparse.SUPPRESS, dest="stage")
+    parser.add_argument("--state", default=None, help=argparse.SUPPRESS, dest="state")
+    args = parser.parse_args()
+
+    if args.case is not None:
+        # Run a single case (or a single stage of it) in this process, as requested by
+        # run_benchmarks
+        if args.stage is not None:
+            print(json.dumps(run_stage(json.loads(args.case), args.stage, args.state)))
+        else:
+            print(json.dumps(run_case(json.loads(args.case), args.trace_memory)))
+        sys.exit(0)
+    cases = [{"rows": rows, "columns": columns, "cardinality": cardinality, "classes": classes,
+              "noise": noise, "trees": trees, "jobs": jobs, "max_features": args.max_features,
+              "training_fraction": args.training_fraction, "seed": args.seed}
+             for rows, columns, cardinality, classes, noise, trees, jobs
+             in product(args.rows, args.columns, args.cardinality, args.classes, args.noise,
+                        args.trees, args.jobs)]
+    with tempfile.TemporaryDirectory() as directory:
+        results = run_benchmarks(cases, directory)
+    report = {"python": platform.python_version(), "platform": platform.platform(),
+              "stages": STAGES, "cases": results}
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["cases"]
+        report["regressions"] = compare_results(results, baseline, args.tolerance)
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    for regression in report.get("regressions", []):
+        print("REGRESSION {} {}: {} -> {} ({:+.0%}) [{}]".format(
+            regression["stage"], regression["measure"], regression["baseline"],
+            regression["value"], regression["change"], _format_case(regression["parameters"])),
+            file=sys.stderr)
+    sys.exit(1 if report.get("regressions") else 0)
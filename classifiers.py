@@ -1,57 +1,533 @@
 from __future__ import division
+import sys
+import warnings
+from array import array
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heappop, heappush
+from itertools import chain, compress, count, repeat
 from math import log
-from random import randint, sample
+from operator import not_
+from multiprocessing import cpu_count, get_all_start_methods, get_context
+from random import getrandbits, Random, sample
+from statistics import mean, pstdev
 
-from dataset import copy_dataset, Dataset
-from decision_tree import DecisionNode, EndNode
+import instrumentation
+from decision_tree import CompiledForest, DecisionNode, EndNode
 
 
+# Dataset shared with the worker processes that train the trees of a random forest
+_shared_dataset = None
+# Forest, encoded dataset and votes shared with the worker processes that compute the permutation
+# importances
+_shared_permutation_state = None
+# Trees that can be replaced when a forest is grown
+_REPLACED_TREES = ("oldest", "worst")
+# Orders in which the nodes of a decision tree can be grown
+_GROWTH_ORDERS = ("depth-first", "best-first")
+# Kinds of feature importance computed from the nodes of the trees
+_IMPORTANCE_TYPES = ("count", "gain")
+
+
+class _TreeBuilder:
+    """
+    Class that builds the decision trees of ID3 on a buffer of instance indexes
+
+    The nodes are grown from a work queue instead of recursively. Every node starts as an end node
+    associated to its most common target, and it is queued (together with its best split) if it can
+    be split; a queued node is replaced by a decision node when it is taken from the queue, unless
+    its children would exceed the maximum number of end nodes. The instances are never copied: the
+    children of a node are formed by partitioning in place the slice of the index buffer that
+    belongs to the node.
+
+    When thread pools are given, the candidate attributes of the large nodes are scored in
+    parallel, and the large children are built as separate subtrees by other threads (unless the
+    number of end nodes is limited, which depends on the order in which the nodes are split). Each
+    node draws its features from its own random number generator, seeded by its parent, so the
+    tree does not depend on the order in which the nodes are built. The threads only run at the
+    same time on a free-threaded build of Python; with the global interpreter lock they take turns.
+
+    When the number of children of a node is limited, the values of an attribute that has more
+    values than allowed are grouped by their target distribution, and every group shares a child.
+
+    When all the attributes are scored at every node (no max_features), each queued node keeps the
+    contingency tables of its attributes, so that the tables of its largest child are obtained by
+    subtracting the tables of the other children from them instead of scanning its instances.
+    """
+
+    # CONSTRUCTOR
+    def __init__(self, dataset, indexes, max_features=None, weights=None, max_depth=None,
+                 min_samples_split=2, min_samples_leaf=1, min_information_gain=None,
+                 max_leaf_nodes=None, best_first=False, split_executor=None, tree_executor=None,
+                 min_parallel_instances=10000, max_children=None):
+        """
+        Build a new _TreeBuilder
+
+        Parameters:
+            - dataset: the dataset used to train the classifier (Dataset)
+            - indexes: the buffer of instance indexes shared by all the nodes of the tree (array of
+              ints)
+            - max_features: the number of features to consider when looking for the best split
+              (number)
+            - weights: the number of times each instance of the dataset has to be counted, default
+              to None (sequence of ints)
+            - max_depth: the maximum depth of the tree, default to None (int)
+            - min_samples_split: the minimum number of instances that a node needs to be split,
+              default to 2 (int)
+            - min_samples_leaf: the minimum number of instances of each child of a split, default
+              to 1 (int)
+            - min_information_gain: the minimum information gain of a split, default to None
+              (number)
+            - max_leaf_nodes: the maximum number of end nodes of the tree, default to None (int)
+            - best_first: whether the node with the highest information gain has to be split
+              first, instead of the last queued one, default to False (bool)
+            - split_executor: the threads that score the candidate attributes, default to None
+              (ThreadPoolExecutor)
+            - tree_executor: the threads that build the subtrees, default to None
+              (ThreadPoolExecutor)
+            - min_parallel_instances: the minimum number of instances of a node whose attributes
+              are scored in parallel, or of a child built by another thread, default to 10000 (int)
+            - max_children: the maximum number of children of a decision node, default to None
+              (int)
+        """
+        self.dataset = dataset
+        self.indexes = indexes
+        self.max_features = max_features
+        self.weights = weights
+        self.max_depth = max_depth
+        self.min_samples_split = min_samples_split
+        self.min_samples_leaf = min_samples_leaf
+        self.min_information_gain = min_information_gain
+        self.max_leaf_nodes = max_leaf_nodes
+        self.best_first = best_first
+        self.split_executor = split_executor
+        self.tree_executor = tree_executor if max_leaf_nodes is None else None
+        self.min_parallel_instances = min_parallel_instances
+        self.max_children = max_children
+        # The tables of a node can be reused by its children only if they cover all the attributes
+        self.reuse_tables = max_features is None
+        self.sequence = count()
+        self.subtrees = deque()
+
+    def build(self, attributes_names, random_state=None):
+        """
+        Return the decision tree built on all the instances of the buffer (DecisionNode or EndNode)
+
+        Parameters:
+            - attributes_names: the names of the attributes that can be used to split (list of
+              Strings)
+            - random_state: the random number generator used to choose the features, default to
+              None (the global one of the random module) (Random)
+        """
+        if self.max_features is not None and random_state is None:
+            random_state = Random(getrandbits(32))
+        tree = self._build_subtree(0, len(self.indexes), attributes_names, 0, random_state)
+        # The subtrees built by other threads may have started other subtrees in turn
+        while self.subtrees:
+            parent, values, subtree = self.subtrees.popleft()
+            _set_node(None, parent, values, subtree.result())
+        return tree
+
+    # PRIVATE METHODS
+    # These methods should not be used outside the class
+    def _build_subtree(self, start, end, attributes_names, depth, random_state,
+                       counts=(None, None)):
+        """
+        Return the decision tree built on the instances whose indexes are stored in
+        indexes[start:end], without the subtrees started in other threads (DecisionNode or EndNode)
+
+        Parameters:
+            - start: the position of the first index of the subtree in the buffer (int)
+            - end: the position following the last index of the subtree in the buffer (int)
+            - attributes_names: the names of the attributes that can be used to split (list of
+              Strings)
+            - depth: the depth of the root of the subtree (int)
+            - random_state: the random number generator of the root of the subtree (Random)
+            - counts: the target counts and the contingency tables of the root of the subtree, if
+              already known, default to (None, None) ((Counter, {String: Counter}))
+        """
+        tree = [None]
+        n_of_leaves = 1
+        root = self._add_node(tree, start, end, attributes_names, depth, None, None, random_state,
+                              *counts)
+        queue = [] if root is None else [root]
+        while queue:
+            entry = heappop(queue) if self.best_first else queue.pop()
+            (_, _, start, end, attributes_names, depth, parent, values, best_attribute,
+             values_groups, information_gain, n_of_instances, random_state,
+             contingency_tables) = entry
+            groups = _partition(self.dataset.get_column(best_attribute), self.indexes, start, end,
+                                values_groups)
+            if (self.max_leaf_nodes is not None
+                    and n_of_leaves + len(groups) - 1 > self.max_leaf_nodes):
+                continue
+            n_of_leaves += len(groups) - 1
+            decision_node = DecisionNode(best_attribute, information_gain, n_of_instances)
+            _set_node(tree, parent, values, decision_node)
+            remaining_attributes_names = [attribute_name for attribute_name in attributes_names
+                                          if attribute_name != best_attribute]
+            vocabulary = self.dataset.get_vocabulary(best_attribute)
+            if contingency_tables is None:
+                children_counts = repeat((None, None))
+            else:
+                children_counts = self._get_children_counts(groups, remaining_attributes_names,
+                                                            depth + 1, contingency_tables)
+            children = []
+            for (key, child_start, child_end), child_counts in zip(groups, children_counts):
+                child_codes = [key] if values_groups is None else values_groups[key]
+                child_values = [vocabulary.get_value(code) for code in child_codes]
+                child_random_state = (None if random_state is None
+                                      else Random(random_state.getrandbits(32)))
+                if (self.tree_executor is not None
+                        and child_end - child_start >= self.min_parallel_instances):
+                    # The child keeps its position among the children until its subtree is built
+                    _set_node(None, decision_node, child_values, None)
+                    self.subtrees.append((decision_node, child_values, self.tree_executor.submit(
+                        self._build_subtree, child_start, child_end, remaining_attributes_names,
+                        depth + 1, child_random_state, child_counts)))
+                    continue
+                children.append(self._add_node(tree, child_start, child_end,
+                                               remaining_attributes_names, depth + 1,
+                                               decision_node, child_values, child_random_state,
+                                               *child_counts))
+            children = [child for child in children if child is not None]
+            if self.best_first:
+                for child in children:
+                    heappush(queue, child)
+            else:
+                # The first child has to be the first one taken from the queue
+                queue.extend(reversed(children))
+        return tree[0]
+
+    def _add_node(self, tree, start, end, attributes_names, depth, parent, values, random_state,
+                  target_counts=None, contingency_tables=None):
+        """
+        Add a new end node to the tree and return its queue entry, None if it can not be split
+        (tuple)
+
+        Parameters:
+            - tree: the holder of the root of the tree (list)
+            - start: the position of the first index of the node in the buffer (int)
+            - end: the position following the last index of the node in the buffer (int)
+            - attributes_names: the names of the attributes that can be used to split (list of
+              Strings)
+            - depth: the depth of the node (int)
+            - parent: the parent of the node, None for the root (DecisionNode)
+            - values: the attribute values of the parent associated to the node (list of values)
+            - random_state: the random number generator of the node (Random)
+            - target_counts: the (weighted) number of instances of the node for each target code,
+              if already known, default to None (Counter)
+            - contingency_tables: the contingency table of each attribute on the instances of the
+              node, if already known, default to None ({String: Counter})
+        """
+        rows = memoryview(self.indexes)[start:end]
+        if target_counts is None:
+            target_counts = self._count_targets(rows)
+        most_common = target_counts.most_common(1)
+        target_vocabulary = self.dataset.get_target_vocabulary()
+        _set_node(tree, parent, values,
+                  EndNode(target_vocabulary.get_value(most_common[0][0]) if most_common else None))
+        if not self._can_split(target_counts, attributes_names, depth):
+            return None
+        if self.reuse_tables:
+            if contingency_tables is None:
+                contingency_tables = self._get_contingency_tables(rows, attributes_names)
+            best_attribute, information_gain, values_groups = _get_best_attribute_from_tables(
+                attributes_names, contingency_tables, target_counts, self.min_samples_leaf,
+                self.max_children)
+        else:
+            split_executor = (self.split_executor if end - start >= self.min_parallel_instances
+                              else None)
+            best_attribute, information_gain, values_groups = _get_best_attribute(
+                self.dataset, attributes_names, rows, self.max_features, random_state,
+                self.weights, self.min_samples_leaf, split_executor, self.max_children)
+        if best_attribute is None or (self.min_information_gain is not None
+                                      and information_gain < self.min_information_gain):
+            return None
+        priority = -information_gain if self.best_first else 0
+        return (priority, next(self.sequence), start, end, attributes_names, depth, parent, values,
+                best_attribute, values_groups, information_gain, sum(target_counts.values()),
+                random_state, contingency_tables)
+
+    def _can_split(self, target_counts, attributes_names, depth):
+        """
+        Return whether a node can be split, according to its instances and the stopping criteria
+        (bool)
+
+        Parameters:
+            - target_counts: the (weighted) number of instances of the node for each target code
+              (Counter)
+            - attributes_names: the names of the attributes that can be used to split (list of
+              Strings)
+            - depth: the depth of the node (int)
+        """
+        return (len(target_counts) > 1 and len(attributes_names) > 0
+                and (self.max_depth is None or depth < self.max_depth)
+                and sum(target_counts.values()) >= self.min_samples_split)
+
+    def _count_targets(self, rows):
+        """
+        Return the (weighted) number of instances for each target code (Counter)
+
+        Parameters:
+            - rows: the indexes of the instances (sequence of ints)
+        """
+        target = self.dataset.get_target_column()
+        return _count(map(target.__getitem__, rows), _get_weights(self.weights, rows))
+
+    def _get_contingency_tables(self, rows, attributes_names):
+        """
+        Return the contingency table of each attribute, computed on the given instances ({String:
+        Counter})
+
+        Parameters:
+            - rows: the indexes of the instances (sequence of ints)
+            - attributes_names: the names of the attributes (list of Strings)
+        """
+        instrumentation.count("rows_scanned", len(rows)*len(attributes_names))
+        targets = list(map(self.dataset.get_target_column().__getitem__, rows))
+        rows_weights = _get_weights(self.weights, rows)
+        if rows_weights is not None:
+            rows_weights = list(rows_weights)
+        executor = self.split_executor if len(rows) >= self.min_parallel_instances else None
+        tables = (map if executor is None else executor.map)(
+            _contingency_table, repeat(self.dataset), attributes_names, repeat(rows),
+            repeat(targets), repeat(rows_weights))
+        return dict(zip(attributes_names, tables))
+
+    def _get_children_counts(self, groups, attributes_names, depth, contingency_tables):
+        """
+        Return the target counts and the contingency tables (None if the child can not be split)
+        of each child of a node (list of (Counter, {String: Counter}))
+
+        The contingency tables of the largest child are obtained by subtracting the tables of the
+        other children from the ones of the node, unless scanning the children that can not be
+        split and subtracting the tables would cost more than scanning the largest child itself.
+
+        Parameters:
+            - groups: the key and the slice of the buffer of each child, as returned by _partition
+              (list of (int, int, int))
+            - attributes_names: the names of the attributes that can be used by the children (list
+              of Strings)
+            - depth: the depth of the children (int)
+            - contingency_tables: the contingency table of each attribute of the node, a superset
+              of the ones of the children ({String: Counter})
+        """
+        indexes = memoryview(self.indexes)
+        children_rows = [indexes[start:end] for _, start, end in groups]
+        largest = max(range(len(groups)), key=lambda index: len(children_rows[index]))
+        others = [index for index in range(len(groups)) if index != largest]
+        # The target counts are always counted, since their order breaks the ties of the majority
+        children_target_counts = [self._count_targets(rows) for rows in children_rows]
+        splittable = [self._can_split(counts, attributes_names, depth)
+                      for counts in children_target_counts]
+        children_tables = [None]*len(groups)
+        for index in others:
+            if splittable[index]:
+                children_tables[index] = self._get_contingency_tables(children_rows[index],
+                                                                      attributes_names)
+        if not splittable[largest]:
+            return list(zip(children_target_counts, children_tables))
+        # Subtracting a pair of counts costs about as much as counting one and a half instances
+        subtraction_cost = 1.5*len(groups)*sum(len(contingency_tables[attribute_name])
+                                               for attribute_name in attributes_names)
+        scan_cost = len(attributes_names)*sum(len(children_rows[index]) for index in others
+                                              if not splittable[index])
+        if scan_cost + subtraction_cost >= len(attributes_names)*len(children_rows[largest]):
+            children_tables[largest] = self._get_contingency_tables(children_rows[largest],
+                                                                    attributes_names)
+            return list(zip(children_target_counts, children_tables))
+        # The tables of the children that can not be split are needed only for the subtraction
+        others_tables = [children_tables[index] if splittable[index]
+                         else self._get_contingency_tables(children_rows[index], attributes_names)
+                         for index in others]
+        instrumentation.count("tables_subtracted", len(attributes_names))
+        children_tables[largest] = {
+            attribute_name: _subtract_counts(contingency_tables[attribute_name],
+                                             [tables[attribute_name] for tables in others_tables])
+            for attribute_name in attributes_names}
+        return list(zip(children_target_counts, children_tables))
+
 # PUBLIC FUNCTIONS
-def random_forest(dataset, n_of_trees, max_features):
+def random_forest(dataset, n_of_trees, max_features, n_jobs=1, seed=None, tree_parameters=None,
+                  oob_score=False, indexes=None):
     """
     Return a list of decision trees, built using random samples of the dataset
 
+    If oob_score is True, the out-of-bag estimate of the accuracy is computed while the trees are
+    built: each instance is classified by the trees whose sample left it out, as soon as they are
+    built. The out-of-bag accuracy (None if no instance has been left out) and, for each target
+    value, the number of its instances correctly classified and the number of its instances that
+    have been left out by at least a tree are returned together with the forest
+    (list of DecisionNode or EndNode, number, {value: (int, int)}).
+
+    If indexes are given, the samples are drawn from those instances only, so that a part of the
+    dataset (such as the training folds of a cross-validation) is used without being copied.
+
     Parameters:
         - dataset: the dataset used to train the classifier (Dataset)
         - n_of_trees: the number of trees that have to be trained (number)
         - max_features: the number of features to consider when looking for the best split (number)
+        - n_jobs: the number of processes used to train the trees, -1 to use all the CPU cores,
+          default to 1 (int)
+        - seed: the number used to initialize the random number generators, default to None
+          (int)
+        - tree_parameters: the parameters of ID3 that control the growth of the trees (max_depth,
+          min_samples_split, min_samples_leaf, min_information_gain, max_leaf_nodes, growth,
+          n_threads, min_parallel_instances, max_children), default to None (the defaults of ID3)
+          ({String: value})
+        - oob_score: whether the out-of-bag accuracy has to be computed, default to False (bool)
+        - indexes: the positions of the instances of the dataset used to train the trees, default
+          to None (all the instances) (sequence of ints)
     """
+    if tree_parameters is None:
+        tree_parameters = {}
+    # Every tree gets its own seed, so the forest does not depend on the number of processes
+    if seed is None:
+        seeds = [getrandbits(32) for _ in range(0, n_of_trees)]
+    else:
+        seed_generator = Random(seed)
+        seeds = [seed_generator.getrandbits(32) for _ in range(0, n_of_trees)]
+    if n_jobs == -1:
+        n_jobs = cpu_count()
+    if n_jobs == 1 or n_of_trees <= 1:
+        decision_trees = (_train_tree(dataset, max_features, tree_seed, tree_parameters, indexes)
+                          for tree_seed in seeds)
+    else:
+        decision_trees = _train_trees_in_pool(dataset, max_features, seeds,
+                                              min(n_jobs, n_of_trees), tree_parameters, indexes)
+    if not oob_score:
+        return list(decision_trees)
     forest = []
-    for _1 in range(0, n_of_trees):
-        random_dataset = Dataset(dataset.get_attributes_names(), dataset.get_target_name())
-        for _2 in range(0, dataset.count_instances()):
-            random_instance = dataset.get_instance(randint(0, dataset.count_instances()-1))
-            attributes_values = [random_instance.get_attribute_value(attribute_name)
-                                 for attribute_name in dataset.get_attributes_names()]
-            target_value = random_instance.get_target_value()
-            random_dataset.add_instance(attributes_values, target_value)
-        forest.append(ID3(random_dataset, max_features))
+    instances_votes = [{} for _ in range(dataset.count_instances())]
+    for tree_seed, decision_tree in zip(seeds, decision_trees):
+        forest.append(decision_tree)
+        with instrumentation.phase("oob_votes"):
+            _add_oob_votes(dataset, decision_tree, tree_seed, instances_votes, indexes)
+    return (forest,) + _get_oob_score(dataset, instances_votes)
+
+def grow_forest(forest, dataset, n_of_trees, max_features, n_jobs=1, seed=None,
+                tree_parameters=None, replace=None):
+    """
+    Return the random forest with new decision trees, built using random samples of the dataset,
+    added after the existing ones (list of DecisionNode or EndNode, or CompiledForest)
+
+    Only the new trees are trained. A compiled forest (for instance, a loaded one) gets the new
+    trees in place: its vocabularies are kept, and extended with the values that it has never
+    seen. If replace is given, as many existing trees as the new ones are removed: the oldest ones
+    (the first ones of the forest) or the worst ones (the ones that correctly classify the fewest
+    instances of the dataset; when the dataset contains only new instances, this is an
+    out-of-bag estimate, since no existing tree has been trained on them).
+
+    Parameters:
+        - forest: the random forest that has to be grown (List of DecisionNode or EndNode, or
+          CompiledForest, not memory-mapped)
+        - dataset: the dataset used to train the new trees (Dataset)
+        - n_of_trees: the number of trees that have to be trained (number)
+        - max_features: the number of features to consider when looking for the best split (number)
+        - n_jobs: the number of processes used to train the trees, -1 to use all the CPU cores,
+          default to 1 (int)
+        - seed: the number used to initialize the random number generators, default to None
+          (int)
+        - tree_parameters: the parameters of ID3 that control the growth of the trees, as in
+          random_forest, default to None (the defaults of ID3) ({String: value})
+        - replace: the trees that have to be replaced by the new ones, "oldest" or "worst",
+          default to None (no tree is removed) (String)
+    """
+    if replace is not None and replace not in _REPLACED_TREES:
+        raise ValueError("Unknown trees to replace: {}".format(replace))
+    n_of_existing_trees = (forest.count_trees() if isinstance(forest, CompiledForest)
+                           else len(forest))
+    removed_trees = []
+    if replace == "oldest":
+        removed_trees = range(min(n_of_trees, n_of_existing_trees))
+    elif replace == "worst":
+        # The trees are judged before the new ones are trained, ties go to the oldest ones
+        trees_correct_counts = _get_trees_correct_counts(forest, dataset)
+        removed_trees = sorted(range(n_of_existing_trees),
+                               key=trees_correct_counts.__getitem__)[:n_of_trees]
+    decision_trees = random_forest(dataset, n_of_trees, max_features, n_jobs, seed,
+                                   tree_parameters)
+    if not isinstance(forest, CompiledForest):
+        removed_trees = set(removed_trees)
+        return [decision_tree for index, decision_tree in enumerate(forest)
+                if index not in removed_trees] + decision_trees
+    forest.remove_trees(removed_trees)
+    for decision_tree in decision_trees:
+        forest.add_tree(decision_tree)
     return forest
 
-def ID3(dataset, max_features=None):
+def ID3(dataset, max_features=None, random_state=None, weights=None, max_depth=None,
+        min_samples_split=2, min_samples_leaf=1, min_information_gain=None, max_leaf_nodes=None,
+        growth="depth-first", n_threads=1, min_parallel_instances=10000, max_children=None):
     """
     Return a decision tree classifier, computed using the ID3 algorithm (DecisionNode or EndNode)
 
+    The number of instances of a node is weighted: an instance drawn twice by a bootstrap sample
+    counts as two instances. Every node draws its features from its own random number generator,
+    seeded by its parent, so the tree is the same for any number of threads.
+
+    When the number of children is limited, the values of an attribute that has more values than
+    allowed are sorted by the fraction of their instances that belong to the most common target of
+    the node, and they are split into contiguous groups, one bisection at a time (always the one
+    with the highest information gain). The information gain of the attribute is the one of the
+    grouped split, and the values of a group are all associated to the same child, so the size of
+    the tree does not grow with the number of values.
+
     Parameters:
         - dataset: the dataset used to train the classifier (Dataset)
         - max_features: the number of features to consider when looking for the best split (number)
+        - random_state: the random number generator used to choose the features, default to None
+          (the global one of the random module) (Random)
+        - weights: the number of times each instance of the dataset has to be counted, default to
+          None (every instance is counted once) (sequence of ints)
+        - max_depth: the maximum depth of the tree, default to None (unlimited) (int)
+        - min_samples_split: the minimum number of instances that a node needs to be split, default
+          to 2 (int)
+        - min_samples_leaf: the minimum number of instances of each child of a split, default to 1
+          (int)
+        - min_information_gain: the minimum information gain of a split, default to None (any
+          split is allowed) (number)
+        - max_leaf_nodes: the maximum number of end nodes of the tree, default to None (unlimited)
+          (int)
+        - growth: the order in which the nodes are split, "depth-first" or "best-first" (the nodes
+          with the highest information gain first, which matters when the number of end nodes is
+          limited), default to "depth-first" (String)
+        - n_threads: the number of threads that score the candidate attributes of the large nodes
+          and build the large subtrees, only used on a free-threaded build of Python (with the
+          global interpreter lock the threads take turns and make the tree slower, so the tree is
+          built by a single thread, with a warning), default to 1 (int)
+        - min_parallel_instances: the minimum number of instances of a node whose attributes are
+          scored in parallel, or of a subtree built by another thread, default to 10000 (int)
+        - max_children: the maximum number of children of a decision node (at least 2), default to
+          None (a child for each value) (int)
     """
-    if len(dataset.get_target_values()) == 1:
-        return EndNode(dataset.get_instance(0).get_target_value())
-    if len(dataset.get_attributes_names()) == 0:
-        return EndNode(dataset.get_most_common_target())
-    best_attribute = _get_best_attribute(dataset, max_features)
-    decision_node = DecisionNode(best_attribute)
-    for attribute_value in dataset.get_attribute_values(best_attribute):
-        if dataset.count_instances(target=None, attribute={"name": best_attribute,
-                                                           "value": attribute_value}) == 0:
-            child = EndNode(dataset.get_most_common_target())
-            decision_node.add_child(attribute_value, child)
-        else:
-            child = ID3(copy_dataset(dataset, attribute={"name": best_attribute,
-                                                         "value": attribute_value}), max_features)
-            decision_node.add_child(attribute_value, child)
-    return decision_node
+    if growth not in _GROWTH_ORDERS:
+        raise ValueError("Unknown growth order: {}".format(growth))
+    if max_children is not None and max_children < 2:
+        raise ValueError("max_children has to be at least 2: {}".format(max_children))
+    if weights is None:
+        indexes = array("I", range(dataset.count_instances()))
+    else:
+        indexes = array("I", compress(range(dataset.count_instances()), weights))
+    if n_threads > 1 and getattr(sys, "_is_gil_enabled", lambda: True)():
+        warnings.warn("n_threads is ignored while the global interpreter lock is enabled: the "
+                      "threads would take turns and slow down the training", RuntimeWarning)
+        n_threads = 1
+    split_executor = tree_executor = None
+    if n_threads > 1:
+        split_executor = ThreadPoolExecutor(n_threads)
+        tree_executor = ThreadPoolExecutor(n_threads)
+    try:
+        tree_builder = _TreeBuilder(dataset, indexes, max_features, weights, max_depth,
+                                    min_samples_split, min_samples_leaf, min_information_gain,
+                                    max_leaf_nodes, growth == "best-first", split_executor,
+                                    tree_executor, min_parallel_instances, max_children)
+        return tree_builder.build(dataset.get_attributes_names(), random_state)
+    finally:
+        if n_threads > 1:
+            split_executor.shutdown()
+            tree_executor.shutdown()
 
 def get_accuracy(dataset, predictions):
     """
@@ -80,37 +556,116 @@ def id3_classify(decision_tree, instance):
         return None
     return id3_classify(decision_tree.get_child(instance.get_attribute_value(decision_attribute_name)), instance)
 
-def random_forest_classify(forest, dataset):
+def random_forest_classify(forest, dataset, probabilities=False, indexes=None):
     """
     Return the target values that the random forest associates to the given dataset (List ofvalue)
 
+    Every tree votes for a target value. A tree that is not able to classify an instance (because
+    it has never seen one of its attribute values) votes for None, which takes part in the vote as
+    any other target value. Ties are broken in favor of the tied target value that comes first in
+    the votes of the trees, taken in the order of the forest.
+
     Parameters:
-        - forest: random forest that determines which target is associated to the instance
-          (List of DecisionNode or EndNode)
+        - forest: random forest that determines which target is associated to the instance, which
+          is compiled on every call if it is a list (List of DecisionNode or EndNode, or
+          CompiledForest)
         - dataset: the dataset that has to be classified (DatasetInstance)
+        - probabilities: whether the fraction of trees that vote for each target value has to be
+          returned as well, default to False (bool)
+        - indexes: the positions of the instances of the dataset that have to be classified, in
+          the order of the predictions, default to None (all the instances) (sequence of ints)
     """
-    # This function is private and should not be used outside the scope of the parent function
-    def _classify_instance(forest, instance):
-        targets = {}
-        for decision_tree in forest:
-            target_value = id3_classify(decision_tree, instance)
-            if target_value in targets:
-                targets[target_value] += 1
-            else:
-                targets[target_value] = 1
-        return max(targets, key=targets.get)
-    predictions = []
-    for instance in dataset:
-        predictions.append(_classify_instance(forest, instance))
-    return predictions
+    n_of_instances = dataset.count_instances() if indexes is None else len(indexes)
+    with instrumentation.inference(n_of_instances):
+        if not isinstance(forest, CompiledForest):
+            forest = compile_forest(forest)
+        if indexes is None:
+            leaf_codes = forest.get_leaf_codes(forest.encode_dataset(dataset), n_of_instances)
+        else:
+            # The other instances are skipped by the traversal, and their codes are dropped
+            instances_flags = bytearray(dataset.count_instances())
+            for index in indexes:
+                instances_flags[index] = 1
+            leaf_codes = [array(tree_leaf_codes.typecode, map(tree_leaf_codes.__getitem__, indexes))
+                          for tree_leaf_codes in forest.get_leaf_codes(
+                              forest.encode_dataset(dataset), dataset.count_instances(),
+                              instances_flags)]
+        target_values = forest.target_vocabulary.get_values()
+        # The votes for None are counted after the ones of the target codes, as the code -1 suggests
+        votes_values = target_values + [None]
+        instances_votes = _count_votes(leaf_codes, len(target_values), n_of_instances)
+        predictions = [votes_values[target_code]
+                       for target_code in _get_predicted_codes(leaf_codes, instances_votes)]
+        if probabilities:
+            instances_probabilities = [{target_value: votes[target_code]/forest.count_trees()
+                                        for target_code, target_value in enumerate(target_values)}
+                                       for votes in instances_votes]
+            return predictions, instances_probabilities
+        return predictions
+
+def random_forest_votes(forest, dataset):
+    """
+    Return the target values that each tree of the random forest associates to each instance of the
+    given dataset, as a matrix with one row for each instance and one column for each tree (None
+    if a tree is not able to classify an instance) (List of tuples of values)
+
+    Parameters:
+        - forest: random forest that determines which target is associated to the instance
+          (List of DecisionNode or EndNode, or CompiledForest)
+        - dataset: the dataset that has to be classified (Dataset)
+    """
+    if not isinstance(forest, CompiledForest):
+        forest = compile_forest(forest)
+    leaf_codes = forest.get_leaf_codes(forest.encode_dataset(dataset), dataset.count_instances())
+    values = forest.target_vocabulary.get_values() + [None]
+    return [tuple(map(values.__getitem__, instance_leaf_codes))
+            for instance_leaf_codes in zip(*leaf_codes)]
+
+def compile_forest(forest, dataset=None):
+    """
+    Return the random forest compiled into flat arrays, which can be used to classify large
+    datasets quickly (CompiledForest)
+
+    random_forest_classify compiles a list of trees again on every call, so a forest that classifies
+    several datasets should be compiled once.
+
+    Parameters:
+        - forest: the random forest that has to be compiled (List of DecisionNode or EndNode)
+        - dataset: the dataset whose attributes and vocabularies have to be used by the compiled
+          forest, default to None (the ones found in the trees) (Dataset)
+    """
+    if dataset is None:
+        compiled_forest = CompiledForest()
+    else:
+        compiled_forest = CompiledForest(dataset.get_attributes_names(), dataset.vocabularies,
+                                         dataset.get_target_vocabulary())
+    for decision_tree in forest:
+        compiled_forest.add_tree(decision_tree)
+    return compiled_forest
 
-def get_feature_importances(forest):
+def get_feature_importances(forest, importance_type="count"):
     """
     Return an ordered list of features used in the forest, according to its importance
 
+    The importance of a feature is either the number of decision nodes that use it ("count") or
+    its mean decrease of entropy ("gain"): the information gain of the nodes that use it, weighted
+    by the fraction of the training instances of the tree that reach them, summed over each tree
+    and averaged over the trees. The gains are recorded while the trees are built, so they cost
+    nothing more.
+
     Parameters:
         - forst: random forest from which the importance of the features can be estimated
+          (List of DecisionNode or EndNode, or CompiledForest)
+        - importance_type: the kind of importance, "count" or "gain", default to "count" (String)
     """
+    if importance_type not in _IMPORTANCE_TYPES:
+        raise ValueError("Unknown importance type: {}".format(importance_type))
+    if importance_type == "gain":
+        return _get_gain_importances(forest)
+    if isinstance(forest, CompiledForest):
+        features = Counter(forest.attributes_names[feature] for feature in forest.features
+                           if feature >= 0)
+        return features.most_common()
     features = {}
     # These functions should not be used outside the scope of the parent function
     def _get_feature_importances(decision_tree):
@@ -120,63 +675,842 @@ def get_feature_importances(forest):
             features[decision_tree.get_decision_attribute()] += 1
         else:
             features[decision_tree.get_decision_attribute()] = 1
-        for decision_attribute_value in decision_tree.children.keys():
-            _get_feature_importances(decision_tree.get_child(decision_attribute_value))
+        for child, _ in decision_tree.get_children_groups():
+            _get_feature_importances(child)
     for decision_tree in forest:
         _get_feature_importances(decision_tree)
     return [(feature, features[feature])
             for feature in sorted(features, key=features.get, reverse=True)]
 
+def get_permutation_importances(forest, dataset, n_repeats=5, n_jobs=1, seed=None):
+    """
+    Return the features used in the forest, ordered by their permutation importance, each one with
+    the mean and the standard deviation of the decrease of accuracy on the dataset when its values
+    are shuffled (list of (String, number, number))
+
+    The dataset is encoded once. For each shuffle, only the trees that use the feature classify the
+    instances again (the whole batch at once), while the votes of the other trees are reused.
+
+    Parameters:
+        - forest: the random forest (List of DecisionNode or EndNode, or CompiledForest)
+        - dataset: the dataset on which the accuracy is measured, usually not the training one
+          (Dataset)
+        - n_repeats: the number of times each feature is shuffled, default to 5 (int)
+        - n_jobs: the number of processes that shuffle the features, -1 to use all the CPU cores,
+          default to 1 (int)
+        - seed: the number used to initialize the random number generators, default to None
+          (int)
+    """
+    if dataset.count_instances() == 0:
+        raise ValueError("The dataset has no instances")
+    if not isinstance(forest, CompiledForest):
+        forest = compile_forest(forest)
+    columns = forest.encode_dataset(dataset)
+    leaf_codes = forest.get_leaf_codes(columns, dataset.count_instances())
+    targets = _encode_targets(forest, dataset)
+    trees_features = [{forest.features[node] for node in forest.get_tree_nodes(tree_index)}
+                      for tree_index in range(forest.count_trees())]
+    features = [feature for feature in range(len(forest.attributes_names))
+                if any(feature in tree_features for tree_features in trees_features)]
+    # Every feature gets its own seed, so the importances do not depend on the number of processes
+    seed_generator = Random(getrandbits(32) if seed is None else seed)
+    parameters = [(feature, [tree_index for tree_index, tree_features in enumerate(trees_features)
+                             if feature in tree_features],
+                   seed_generator.getrandbits(32), n_repeats) for feature in features]
+    state = (forest, columns, leaf_codes, targets)
+    if n_jobs == -1:
+        n_jobs = cpu_count()
+    if n_jobs == 1 or len(features) <= 1:
+        decreases = [_score_permutations(state, *feature_parameters)
+                     for feature_parameters in parameters]
+    else:
+        decreases = _score_permutations_in_pool(state, parameters, min(n_jobs, len(features)))
+    importances = [(forest.attributes_names[feature], mean(feature_decreases),
+                    pstdev(feature_decreases))
+                   for feature, feature_decreases in zip(features, decreases)]
+    return sorted(importances, key=lambda importance: importance[1], reverse=True)
+
 
 # PRIVATE FUNCTIONS
 # These functions should not be used outside the module
-def _get_best_attribute(dataset, max_features=None):
+def _train_tree(dataset, max_features, seed, tree_parameters, indexes=None):
+    """
+    Return a decision tree built using a random sample (with replacement) of the dataset
+    (DecisionNode or EndNode)
+
+    Parameters:
+        - dataset: the dataset used to train the classifier (Dataset)
+        - max_features: the number of features to consider when looking for the best split (number)
+        - seed: the number used to initialize the random number generator of the tree (int)
+        - tree_parameters: the parameters of ID3 that control the growth of the tree
+          ({String: value})
+        - indexes: the positions of the instances from which the sample is drawn, default to None
+          (all the instances) (sequence of ints)
+    """
+    tree_start = instrumentation.start_tree()
+    random_state = Random(seed)
+    with instrumentation.phase("bootstrap"):
+        weights = _bootstrap_weights(dataset.count_instances(), random_state, indexes)
+    with instrumentation.phase("build_tree"):
+        decision_tree = ID3(dataset, max_features, random_state, weights, **tree_parameters)
+    instrumentation.add_tree(decision_tree, tree_start)
+    return decision_tree
+
+def _bootstrap_weights(n_of_instances, random_state, indexes=None):
+    """
+    Return how many times each instance is drawn by a random sample (with replacement) of the
+    same size of the dataset, or of the given instances (array of ints)
+
+    Parameters:
+        - n_of_instances: the number of instances of the dataset (int)
+        - random_state: the random number generator used to draw the sample (Random)
+        - indexes: the positions of the instances from which the sample is drawn, default to None
+          (all the instances) (sequence of ints)
+    """
+    if indexes is None:
+        indexes = range(n_of_instances)
+    weights = array("H", bytes(2*n_of_instances))
+    for index, count in Counter(random_state.choices(indexes, k=len(indexes))).items():
+        weights[index] = count
+    return weights
+
+def _train_trees_in_pool(dataset, max_features, seeds, n_jobs, tree_parameters, indexes=None):
+    """
+    Return an iterator over the decision trees built by a pool of processes, one for each seed in
+    the order of the seeds, each one available as soon as it is built (iterator of DecisionNode or
+    EndNode)
+
+    The dataset is handed to the workers only once: forked workers inherit it from the parent
+    process, otherwise it is sent to each of them when they start. If the instrumentation is
+    enabled, the metrics collected by the workers are added to the ones of the current process.
+
+    Parameters:
+        - dataset: the dataset used to train the classifier (Dataset)
+        - max_features: the number of features to consider when looking for the best split (number)
+        - seeds: the seeds of the trees that have to be trained (list of ints)
+        - n_jobs: the number of processes used to train the trees (int)
+        - tree_parameters: the parameters of ID3 that control the growth of the trees
+          ({String: value})
+        - indexes: the positions of the instances from which the samples are drawn, default to
+          None (all the instances) (sequence of ints)
+    """
+    global _shared_dataset
+    if "fork" in get_all_start_methods():
+        _shared_dataset = dataset
+        pool = get_context("fork").Pool(n_jobs)
+    else:
+        pool = get_context().Pool(n_jobs, initializer=_share_dataset, initargs=(dataset,))
+    profile = instrumentation.get_profiler() is not None
+    try:
+        with pool:
+            for result in pool.imap(_train_shared_tree, [(max_features, seed, tree_parameters,
+                                                          indexes, profile) for seed in seeds]):
+                if profile:
+                    decision_tree, metrics = result
+                    instrumentation.get_profiler().merge(metrics)
+                    yield decision_tree
+                else:
+                    yield result
+    finally:
+        _shared_dataset = None
+
+def _share_dataset(dataset):
+    """
+    Store the dataset used by the trees trained in the current process
+
+    Parameters:
+        - dataset: the dataset used to train the classifier (Dataset)
+    """
+    global _shared_dataset
+    _shared_dataset = dataset
+
+def _train_shared_tree(parameters):
+    """
+    Return a decision tree built on the dataset shared with the current process, together with the
+    metrics collected while building it if they have to be profiled (DecisionNode or EndNode, or
+    (DecisionNode or EndNode, {String: value}))
+
+    Parameters:
+        - parameters: the maximum number of features, the seed and the parameters of the tree,
+          the instances from which the sample is drawn and whether the tree has to be profiled
+          ((number, int, {String: value}, sequence of ints, bool))
+    """
+    max_features, seed, tree_parameters, indexes, profile = parameters
+    if not profile:
+        return _train_tree(_shared_dataset, max_features, seed, tree_parameters, indexes)
+    profiler = instrumentation.enable()
+    try:
+        decision_tree = _train_tree(_shared_dataset, max_features, seed, tree_parameters, indexes)
+    finally:
+        instrumentation.disable()
+    return decision_tree, profiler.get_metrics()
+
+def _add_oob_votes(dataset, decision_tree, seed, instances_votes, indexes=None):
+    """
+    Add the votes of the decision tree for the instances left out by its sample to the votes of the
+    instances
+
+    Parameters:
+        - dataset: the dataset used to train the classifier (Dataset)
+        - decision_tree: the decision tree (DecisionNode or EndNode)
+        - seed: the number used to initialize the random number generator of the tree (int)
+        - instances_votes: the number of votes for each target code (-1 for the trees that are not
+          able to classify the instance), in the order of the first votes, for each instance of the
+          dataset (list of {int: int})
+        - indexes: the positions of the instances from which the sample has been drawn, default to
+          None (all the instances) (sequence of ints)
+    """
+    n_of_instances = dataset.count_instances()
+    # The sample is drawn again from the seed, exactly as _train_tree does
+    oob_flags = list(map(not_, _bootstrap_weights(n_of_instances, Random(seed), indexes)))
+    if indexes is not None:
+        # The instances that could not be drawn are not out of the bag
+        sampled_flags = bytearray(n_of_instances)
+        for index in indexes:
+            sampled_flags[index] = 1
+        oob_flags = [oob and bool(sampled) for oob, sampled in zip(oob_flags, sampled_flags)]
+    compiled_forest = compile_forest([decision_tree], dataset)
+    leaf_codes = compiled_forest.get_leaf_codes(compiled_forest.encode_dataset(dataset),
+                                                n_of_instances, oob_flags)[0]
+    for index, target_code in zip(compress(range(n_of_instances), oob_flags),
+                                  compress(leaf_codes, oob_flags)):
+        votes = instances_votes[index]
+        votes[target_code] = votes.get(target_code, 0) + 1
+
+def _get_oob_score(dataset, instances_votes):
+    """
+    Return the out-of-bag accuracy (None if no instance has been left out) and, for each target
+    value, the number of its instances correctly classified and the number of its instances that
+    received at least a vote ((number, {value: (int, int)}))
+
+    Each instance is given the target code with most votes, the first voted one in case of ties, as
+    random_forest_classify does.
+
+    Parameters:
+        - dataset: the dataset used to train the classifier (Dataset)
+        - instances_votes: the out-of-bag votes of each instance of the dataset, as built by
+          _add_oob_votes (list of {int: int})
+    """
+    target_vocabulary = dataset.get_target_vocabulary()
+    targets_counts = [[0, 0] for _ in range(len(target_vocabulary))]
+    for target_code, votes in zip(dataset.get_target_column(), instances_votes):
+        if not votes:
+            continue
+        targets_counts[target_code][0] += max(votes, key=votes.get) == target_code
+        targets_counts[target_code][1] += 1
+    n_of_correct = sum(correct for correct, _ in targets_counts)
+    n_of_voted = sum(voted for _, voted in targets_counts)
+    oob_accuracy = n_of_correct/n_of_voted if n_of_voted > 0 else None
+    return oob_accuracy, {target_vocabulary.get_value(target_code): tuple(target_counts)
+                          for target_code, target_counts in enumerate(targets_counts)
+                          if target_counts[1] > 0}
+
+def _get_trees_correct_counts(forest, dataset):
+    """
+    Return the number of instances of the dataset that each tree of the forest classifies
+    correctly (list of ints)
+
+    Parameters:
+        - forest: the random forest (List of DecisionNode or EndNode, or CompiledForest)
+        - dataset: the dataset whose instances have to be classified (Dataset)
+    """
+    if not isinstance(forest, CompiledForest):
+        forest = compile_forest(forest)
+    leaf_codes = forest.get_leaf_codes(forest.encode_dataset(dataset), dataset.count_instances())
+    targets = _encode_targets(forest, dataset)
+    return [sum(map(int.__eq__, tree_leaf_codes, targets)) for tree_leaf_codes in leaf_codes]
+
+def _encode_targets(forest, dataset):
+    """
+    Return the targets of the instances of the dataset, encoded with the vocabulary of the forest
+    (-2 for the targets that the forest has never seen, which no tree can predict) (list of ints)
+
+    Parameters:
+        - forest: the compiled random forest (CompiledForest)
+        - dataset: the dataset (Dataset)
     """
-    Return the attribute of the dataset that best classifies examples of the dataset (String)
+    translation = [forest.target_vocabulary.get_code(value)
+                   for value in dataset.get_target_vocabulary().get_values()]
+    return [-2 if translation[code] is None else translation[code]
+            for code in dataset.get_target_column()]
+
+def _get_predicted_codes(leaf_codes, instances_votes):
+    """
+    Return the target code with most votes for each instance (the number of target codes for None),
+    the first voted one in the order of the trees in case of ties (list of ints)
+
+    Parameters:
+        - leaf_codes: the target codes that each tree associates to each instance, one array for
+          each tree (list of arrays of ints)
+        - instances_votes: the votes of each instance, as returned by _count_votes (list of tuples
+          of ints)
+    """
+    predicted_codes = []
+    for index, votes in enumerate(instances_votes):
+        max_votes = max(votes)
+        target_code = votes.index(max_votes)
+        if votes.count(max_votes) > 1:
+            target_code = next(tree_leaf_codes[index] for tree_leaf_codes in leaf_codes
+                               if votes[tree_leaf_codes[index]] == max_votes)
+            # The code -1 of None is the last one of the votes
+            target_code %= len(votes)
+        predicted_codes.append(target_code)
+    return predicted_codes
+
+def _get_votes_accuracy(leaf_codes, n_of_targets, targets):
+    """
+    Return the accuracy of the forest, given the votes of its trees (number)
+
+    Parameters:
+        - leaf_codes: the target codes that each tree associates to each instance, one array for
+          each tree (list of arrays of ints)
+        - n_of_targets: the number of target codes of the forest (int)
+        - targets: the target code of each instance, as returned by _encode_targets (list of ints)
+    """
+    instances_votes = _count_votes(leaf_codes, n_of_targets, len(targets))
+    predicted_codes = _get_predicted_codes(leaf_codes, instances_votes)
+    return sum(map(int.__eq__, predicted_codes, targets))/len(targets)
+
+def _score_permutations(state, feature, trees_indexes, seed, n_repeats):
+    """
+    Return the decrease of accuracy of the forest caused by each shuffle of a feature (list of
+    numbers)
+
+    Parameters:
+        - state: the compiled forest, the encoded columns of the dataset, the target codes that
+          each tree associates to each instance and the target code of each instance
+          ((CompiledForest, list of sequences of ints, list of arrays of ints, list of ints))
+        - feature: the index of the feature in the forest (int)
+        - trees_indexes: the positions of the trees that use the feature (list of ints)
+        - seed: the number used to initialize the random number generator (int)
+        - n_repeats: the number of shuffles (int)
+    """
+    forest, columns, leaf_codes, targets = state
+    n_of_targets = len(forest.target_vocabulary)
+    accuracy = _get_votes_accuracy(leaf_codes, n_of_targets, targets)
+    random_state = Random(seed)
+    permuted_columns = list(columns)
+    permuted_column = array(memoryview(columns[feature]).format, columns[feature])
+    decreases = []
+    for _ in range(n_repeats):
+        # The copy of the column is shuffled in place again and again
+        random_state.shuffle(permuted_column)
+        permuted_columns[feature] = permuted_column
+        permuted_leaf_codes = list(leaf_codes)
+        for tree_index, tree_leaf_codes in zip(trees_indexes, forest.get_leaf_codes(
+                permuted_columns, len(targets), trees_indexes=trees_indexes)):
+            permuted_leaf_codes[tree_index] = tree_leaf_codes
+        decreases.append(accuracy - _get_votes_accuracy(permuted_leaf_codes, n_of_targets, targets))
+    return decreases
+
+def _score_permutations_in_pool(state, parameters, n_jobs):
+    """
+    Return the decreases of accuracy caused by the shuffles of each feature, computed by a pool of
+    processes (list of lists of numbers)
+
+    The forest and the encoded dataset are handed to the workers only once, as in
+    _train_trees_in_pool.
+
+    Parameters:
+        - state: the forest and the encoded dataset, as required by _score_permutations (tuple)
+        - parameters: the arguments of _score_permutations that follow the state, for each feature
+          (list of tuples)
+        - n_jobs: the number of processes (int)
+    """
+    global _shared_permutation_state
+    if "fork" in get_all_start_methods():
+        _shared_permutation_state = state
+        pool = get_context("fork").Pool(n_jobs)
+    else:
+        pool = get_context().Pool(n_jobs, initializer=_share_permutation_state,
+                                  initargs=(state,))
+    try:
+        with pool:
+            return pool.map(_score_shared_permutations, parameters)
+    finally:
+        _shared_permutation_state = None
+
+def _share_permutation_state(state):
+    """
+    Store the forest and the encoded dataset used by the permutations scored in the current process
+
+    Parameters:
+        - state: the forest and the encoded dataset, as required by _score_permutations (tuple)
+    """
+    global _shared_permutation_state
+    _shared_permutation_state = state
+
+def _score_shared_permutations(parameters):
+    """
+    Return the decreases of accuracy caused by the shuffles of a feature, using the state shared
+    with the current process (list of numbers)
+
+    Parameters:
+        - parameters: the arguments of _score_permutations that follow the state (tuple)
+    """
+    return _score_permutations(_shared_permutation_state, *parameters)
+
+def _get_gain_importances(forest):
+    """
+    Return the features used in the forest with their mean decrease of entropy, ordered by it
+    (list of (String, number))
+
+    Parameters:
+        - forest: the random forest (List of DecisionNode or EndNode, or CompiledForest)
+    """
+    importances = Counter()
+    if isinstance(forest, CompiledForest):
+        n_of_trees = forest.count_trees()
+        for tree_index in range(n_of_trees):
+            n_of_tree_instances = forest.instances_counts[forest.roots[tree_index]]
+            if n_of_tree_instances == 0:
+                continue
+            for node in forest.get_tree_nodes(tree_index):
+                if forest.features[node] >= 0:
+                    importances[forest.attributes_names[forest.features[node]]] += (
+                        forest.gains[node]*forest.instances_counts[node]/n_of_tree_instances)
+    else:
+        n_of_trees = len(forest)
+        for decision_tree in forest:
+            if isinstance(decision_tree, EndNode) or not decision_tree.count_instances():
+                continue
+            nodes = [decision_tree]
+            while nodes:
+                node = nodes.pop()
+                if isinstance(node, EndNode):
+                    continue
+                if node.get_information_gain() is not None:
+                    importances[node.get_decision_attribute()] += (
+                        node.get_information_gain()*node.count_instances()
+                        / decision_tree.count_instances())
+                nodes.extend(child for child, _ in node.get_children_groups())
+    return [(feature, importance/n_of_trees) for feature, importance in importances.most_common()]
+
+def _count_votes(leaf_codes, n_of_targets, n_of_instances):
+    """
+    Return, for each instance, the number of trees that vote for each target code, followed by the
+    number of trees that are not able to classify the instance (List of tuples of ints)
+
+    Parameters:
+        - leaf_codes: the target codes that each tree associates to each instance (-1 if the tree is
+          not able to classify an instance), one array for each tree (list of arrays of ints)
+        - n_of_targets: the number of target codes (int)
+        - n_of_instances: the number of instances (int)
+    """
+    if 0 < len(leaf_codes) <= 0xFF and all(tree_leaf_codes.typecode == "b"
+                                           for tree_leaf_codes in leaf_codes):
+        # The votes of all the trees for a target are summed at once: every tree contributes an
+        # int whose i-th byte is 1 if the tree votes for the target on the i-th instance, and each
+        # byte of the sum can hold at most 255 votes
+        trees_bytes = [tree_leaf_codes.tobytes() for tree_leaf_codes in leaf_codes]
+        targets_votes = []
+        for target_code in list(range(n_of_targets)) + [-1]:
+            target_byte = target_code & 0xFF
+            selector = bytes(target_byte) + b"\x01" + bytes(0xFF - target_byte)
+            votes = sum(int.from_bytes(tree_bytes.translate(selector), "little")
+                        for tree_bytes in trees_bytes)
+            targets_votes.append(votes.to_bytes(n_of_instances, "little"))
+        return list(zip(*targets_votes))
+    instances_votes = []
+    for instance_leaf_codes in zip(*leaf_codes):
+        votes = [0] * (n_of_targets + 1)
+        for target_code in instance_leaf_codes:
+            votes[target_code] += 1
+        instances_votes.append(tuple(votes))
+    return instances_votes
+
+def _set_node(tree, parent, values, node):
+    """
+    Associate a node to its parent, or make it the root of the tree if it has no parent
+
+    Parameters:
+        - tree: the holder of the root of the tree (list)
+        - parent: the parent of the node, None for the root (DecisionNode)
+        - values: the attribute values of the parent associated to the node (list of values)
+        - node: the node (DecisionNode or EndNode)
+    """
+    if parent is None:
+        tree[0] = node
+        return
+    for value in values:
+        parent.add_child(value, node)
+
+def _partition(column, indexes, start, end, values_groups=None):
+    """
+    Stably reorder indexes[start:end] so that the instances sharing the same code of the column (or
+    the same group of codes) are contiguous, and return the position of each group (list of (code,
+    start, end) tuples, or (group index, start, end) tuples if the codes are grouped)
+
+    Parameters:
+        - column: the codes of the attribute used to partition the instances (array of ints)
+        - indexes: the buffer of instance indexes (array of ints)
+        - start: the position of the first index that has to be partitioned (int)
+        - end: the position following the last index that has to be partitioned (int)
+        - values_groups: the groups of codes that have to be kept together, default to None (a
+          group for each code) (list of lists of ints)
+    """
+    rows = indexes[start:end]
+    keys = map(column.__getitem__, rows)
+    if values_groups is not None:
+        groups_indexes = {code: group_index for group_index, codes in enumerate(values_groups)
+                          for code in codes}
+        keys = map(groups_indexes.__getitem__, keys)
+    keys = list(keys)
+    counts = Counter(keys)
+    groups = []
+    positions = {}
+    for key in sorted(counts):
+        positions[key] = start
+        groups.append((key, start, start + counts[key]))
+        start += counts[key]
+    for row, key in zip(rows, keys):
+        indexes[positions[key]] = row
+        positions[key] += 1
+    return groups
+
+def _get_best_attribute(dataset, attributes_names, indexes=None, max_features=None,
+                        random_state=None, weights=None, min_samples_leaf=1, executor=None,
+                        max_children=None):
+    """
+    Return the attribute of the dataset that best classifies examples of the dataset, its
+    information gain and the groups of its codes that share a child (None if every code has its own
+    child), (None, None, None) if no attribute can be used to split ((String, number, list of lists
+    of ints))
 
     Parameters:
         - dataset: the dataset on which the computation has to be done (Dataset)
+        - attributes_names: the names of the candidate attributes (list of Strings)
+        - indexes: the indexes of the instances that have to be taken into account, default to None
+          (all the instances) (sequence of ints)
         - max_features: the number of features to consider when looking for the best split (number)
+        - random_state: the random number generator used to choose the features, default to None
+          (Random)
+        - weights: the number of times each instance of the dataset has to be counted, default to
+          None (sequence of ints)
+        - min_samples_leaf: the minimum number of instances that each value of the attribute must
+          have, default to 1 (int)
+        - executor: the threads that score the attributes, default to None (the attributes are
+          scored one after another) (ThreadPoolExecutor)
+        - max_children: the maximum number of children of the split, default to None (int)
     """
-    attributes_names = dataset.get_attributes_names()
     if max_features is not None:
-        attributes_names = sample(attributes_names, min(max_features, len(attributes_names)))
-    max_information_gain = _information_gain(dataset, attributes_names[0])
-    best_attribute = attributes_names[0]
-    for index in range(1, len(attributes_names)):
-        attribute_name = attributes_names[index]
-        information_gain = _information_gain(dataset, attribute_name)
-        if information_gain > max_information_gain:
-            max_information_gain = information_gain
-            best_attribute = attribute_name
-    return best_attribute
+        sampler = sample if random_state is None else random_state.sample
+        attributes_names = sampler(attributes_names, min(max_features, len(attributes_names)))
+    if indexes is None:
+        indexes = range(dataset.count_instances())
+    instrumentation.count("split_evaluations", len(attributes_names))
+    instrumentation.count("rows_scanned", len(indexes)*len(attributes_names))
+    # The targets of the instances are gathered once and shared by all the candidate attributes
+    targets = list(map(dataset.get_target_column().__getitem__, indexes))
+    indexes_weights = _get_weights(weights, indexes)
+    if indexes_weights is not None:
+        indexes_weights = list(indexes_weights)
+    target_counts = _count(targets, indexes_weights)
+    total = sum(target_counts.values())
+    entropy = _entropy_from_counts(target_counts.values(), total)
+    # The attributes are compared in their order whatever the order in which they are scored
+    scores = (map if executor is None else executor.map)(
+        _score_attribute, repeat(dataset), attributes_names, repeat(indexes), repeat(targets),
+        repeat(indexes_weights), repeat(entropy), repeat(total), repeat(min_samples_leaf),
+        repeat(max_children))
+    return _get_best_score(attributes_names, scores)
+
+def _score_attribute(dataset, attribute_name, indexes, targets, weights, entropy, total,
+                     min_samples_leaf, max_children=None):
+    """
+    Return the information gain of the split on the attribute and the groups of its codes, as
+    returned by _score_table ((number, list of lists of ints))
+
+    Parameters:
+        - dataset: the dataset on which the computation has to be done (Dataset)
+        - attribute_name: the name of the attribute (String)
+        - indexes: the indexes of the instances that have to be taken into account (sequence of
+          ints)
+        - targets: the target codes of the instances (sequence of ints)
+        - weights: the number of times each of the instances has to be counted, aligned with the
+          indexes (sequence of ints)
+        - entropy: the entropy of the instances before the split (number)
+        - total: the total number of instances (int)
+        - min_samples_leaf: the minimum number of instances that each value of the attribute must
+          have (int)
+        - max_children: the maximum number of children of the split, default to None (int)
+    """
+    contingency_table = _contingency_table(dataset, attribute_name, indexes, targets, weights)
+    return _score_table(contingency_table, entropy, total, min_samples_leaf, max_children)
 
-def _entropy(dataset):
+def _get_best_attribute_from_tables(attributes_names, contingency_tables, target_counts,
+                                    min_samples_leaf=1, max_children=None):
     """
-    Return the entropy that characterizes the given dataset (number)
+    Return the attribute that best classifies the instances described by the contingency tables,
+    its information gain and the groups of its codes, as returned by _get_best_attribute ((String,
+    number, list of lists of ints))
 
     Parameters:
-        - dataset: the dataset on which the entropy has to be computed (Dataset)
+        - attributes_names: the names of the candidate attributes (list of Strings)
+        - contingency_tables: the contingency table of each attribute, a superset of the candidate
+          ones ({String: Counter})
+        - target_counts: the (weighted) number of instances for each target code (Counter)
+        - min_samples_leaf: the minimum number of instances that each value of the attribute must
+          have, default to 1 (int)
+        - max_children: the maximum number of children of the split, default to None (int)
     """
-    proportions = [dataset.count_instances(target=target)/dataset.count_instances()
-                   for target in dataset.get_target_values()]
+    instrumentation.count("split_evaluations", len(attributes_names))
+    total = sum(target_counts.values())
+    entropy = _entropy_from_counts(target_counts.values(), total)
+    scores = (_score_table(contingency_tables[attribute_name], entropy, total, min_samples_leaf,
+                           max_children)
+              for attribute_name in attributes_names)
+    return _get_best_score(attributes_names, scores)
+
+def _get_best_score(attributes_names, scores):
+    """
+    Return the first attribute with the highest information gain, its information gain and the
+    groups of its codes, (None, None, None) if no attribute can be used to split ((String, number,
+    list of lists of ints))
+
+    Parameters:
+        - attributes_names: the names of the attributes (list of Strings)
+        - scores: the information gain and the groups of codes of each attribute, as returned by
+          _score_table (iterable of (number, list of lists of ints))
+    """
+    best_attribute, max_information_gain, best_values_groups = None, None, None
+    for attribute_name, (information_gain, values_groups) in zip(attributes_names, scores):
+        if information_gain is None:
+            continue
+        if max_information_gain is None or information_gain > max_information_gain:
+            best_attribute, max_information_gain = attribute_name, information_gain
+            best_values_groups = values_groups
+    return best_attribute, max_information_gain, best_values_groups
+
+def _score_table(contingency_table, entropy, total, min_samples_leaf, max_children=None):
+    """
+    Return the information gain of the split described by a contingency table and the groups of
+    codes that share a child (None if every code has its own child), (None, None) if some child
+    has less instances than required, or if no grouping of the codes splits the instances
+    ((number, list of lists of ints))
+
+    Parameters:
+        - contingency_table: the number of instances for each pair of attribute value and target
+          value ({(int, int): int})
+        - entropy: the entropy of the instances before the split (number)
+        - total: the total number of instances (int)
+        - min_samples_leaf: the minimum number of instances that each value of the attribute must
+          have (int)
+        - max_children: the maximum number of children of the split, default to None (int)
+    """
+    values_groups = None
+    if max_children is not None:
+        values_groups = _group_values(contingency_table, max_children, min_samples_leaf)
+        if values_groups is not None:
+            # A single group would make a decision node with one child
+            if len(values_groups) < 2:
+                return None, None
+            contingency_table = _group_table(contingency_table, values_groups)
+    if min_samples_leaf > 1 and min(_count_values(contingency_table).values()) < min_samples_leaf:
+        return None, None
+    return _information_gain_from_table(contingency_table, entropy, total), values_groups
+
+def _group_values(contingency_table, max_children, min_samples_leaf=1):
+    """
+    Return the groups of attribute codes that have to share a child, so that there are at most
+    max_children groups, None if the attribute does not have more codes than that (list of lists
+    of ints)
+
+    The codes are sorted by the fraction of their instances that belong to the most common target,
+    and the sorted codes are split into contiguous groups, one bisection at a time: the one that
+    reduces the entropy the most among the best bisections of the current groups.
+
+    Parameters:
+        - contingency_table: the number of instances for each pair of attribute value and target
+          value ({(int, int): int})
+        - max_children: the maximum number of groups (int)
+        - min_samples_leaf: the minimum number of instances of each group, default to 1 (int)
+    """
+    values_targets_counts = {}
+    targets_counts = Counter()
+    for (attribute_code, target_code), count in contingency_table.items():
+        values_targets_counts.setdefault(attribute_code, {})[target_code] = count
+        targets_counts[target_code] += count
+    if len(values_targets_counts) <= max_children:
+        return None
+    targets_codes = sorted(targets_counts)
+    # The most common target (the one with the lowest code among the tied ones)
+    reference = max(targets_codes, key=lambda target_code: (targets_counts[target_code],
+                                                           -target_code))
+    codes = sorted(values_targets_counts, key=lambda attribute_code: (
+        values_targets_counts[attribute_code].get(reference, 0)
+        / sum(values_targets_counts[attribute_code].values()), attribute_code))
+    # prefix_counts[i] contains the number of instances of each target among the first i codes
+    prefix_counts = [[0]*len(targets_codes)]
+    for attribute_code in codes:
+        counts = values_targets_counts[attribute_code]
+        prefix_counts.append([previous + counts.get(target_code, 0) for previous, target_code
+                              in zip(prefix_counts[-1], targets_codes)])
+    # These functions should not be used outside the scope of the parent function
+    def _get_bisection(start, end):
+        # Return the best bisection of codes[start:end], None if no bisection reduces the entropy
+        counts = [last - first for first, last in zip(prefix_counts[start], prefix_counts[end])]
+        best_bisection = None
+        for middle in range(start + 1, end):
+            left_counts = [middle_count - first for first, middle_count
+                           in zip(prefix_counts[start], prefix_counts[middle])]
+            right_counts = [count - left_count for count, left_count in zip(counts, left_counts)]
+            if sum(left_counts) < min_samples_leaf or sum(right_counts) < min_samples_leaf:
+                continue
+            gain = (_weighted_entropy(counts) - _weighted_entropy(left_counts)
+                    - _weighted_entropy(right_counts))
+            if gain > 0 and (best_bisection is None or gain > best_bisection[0]):
+                best_bisection = (gain, middle)
+        return best_bisection
+    groups = [(0, len(codes))]
+    bisections = []
+    for start, end in groups:
+        bisection = _get_bisection(start, end)
+        if bisection is not None:
+            heappush(bisections, (-bisection[0], start, end, bisection[1]))
+    while len(groups) < max_children and bisections:
+        _, start, end, middle = heappop(bisections)
+        groups.remove((start, end))
+        for group in [(start, middle), (middle, end)]:
+            groups.append(group)
+            bisection = _get_bisection(*group)
+            if bisection is not None:
+                heappush(bisections, (-bisection[0], group[0], group[1], bisection[1]))
+    return [codes[start:end] for start, end in sorted(groups)]
+
+def _group_table(contingency_table, values_groups):
+    """
+    Return the contingency table of the groups of attribute codes, whose codes are the indexes of
+    the groups ({(int, int): int})
+
+    Parameters:
+        - contingency_table: the number of instances for each pair of attribute value and target
+          value ({(int, int): int})
+        - values_groups: the groups of attribute codes (list of lists of ints)
+    """
+    groups_indexes = {code: group_index for group_index, codes in enumerate(values_groups)
+                      for code in codes}
+    grouped_table = Counter()
+    for (attribute_code, target_code), count in contingency_table.items():
+        grouped_table[(groups_indexes[attribute_code], target_code)] += count
+    return grouped_table
+
+def _contingency_table(dataset, attribute_name, indexes=None, targets=None, weights=None):
+    """
+    Return the (weighted) number of instances for each pair of attribute value and target value,
+    computed with a single pass over the instances ({(int, int): int})
+
+    Parameters:
+        - dataset: the dataset on which the table has to be computed (Dataset)
+        - attribute_name: the name of the attribute (String)
+        - indexes: the indexes of the instances that have to be taken into account, default to None
+          (all the instances) (sequence of ints)
+        - targets: the target codes of the instances, if already known, default to None (sequence of
+          ints)
+        - weights: the number of times each of the instances has to be counted, aligned with the
+          indexes, default to None (sequence of ints)
+    """
+    if indexes is None:
+        indexes = range(dataset.count_instances())
+    if targets is None:
+        targets = map(dataset.get_target_column().__getitem__, indexes)
+    return _count(zip(map(dataset.get_column(attribute_name).__getitem__, indexes), targets),
+                  weights)
+
+def _count_values(contingency_table):
+    """
+    Return the number of instances for each attribute value of a contingency table ({int: int})
+
+    Parameters:
+        - contingency_table: the number of instances for each pair of attribute value and target
+          value ({(int, int): int})
+    """
+    values_counts = Counter()
+    for (attribute_code, _), value_count in contingency_table.items():
+        values_counts[attribute_code] += value_count
+    return values_counts
+
+def _count(keys, weights=None):
+    """
+    Return the number of occurrences of each key, where every occurrence is counted as many times
+    as its weight (Counter)
+
+    Parameters:
+        - keys: the keys that have to be counted (iterable)
+        - weights: the weight of each key, default to None (every key is counted once) (iterable
+          of ints)
+    """
+    if weights is None:
+        return Counter(keys)
+    return Counter(chain.from_iterable(map(repeat, keys, weights)))
+
+def _subtract_counts(counts, others_counts):
+    """
+    Return the counts left after subtracting other counts, without the keys whose count drops to
+    zero (Counter)
+
+    Parameters:
+        - counts: the counts from which the other ones have to be subtracted (Counter)
+        - others_counts: the counts that have to be subtracted, each one contained in the first
+          one (iterable of Counters)
+    """
+    difference = Counter(counts)
+    for other_counts in others_counts:
+        difference.subtract(other_counts)
+    # Unary plus keeps only the positive counts
+    return +difference
+
+def _get_weights(weights, indexes):
+    """
+    Return the weights of the instances at the given indexes, None if the instances are not
+    weighted (iterable of ints)
+
+    Parameters:
+        - weights: the number of times each instance of the dataset has to be counted (sequence of
+          ints)
+        - indexes: the indexes of the desired instances (iterable of ints)
+    """
+    if weights is None:
+        return None
+    return map(weights.__getitem__, indexes)
+
+def _entropy_from_counts(counts, total):
+    """
+    Return the entropy of a distribution, given the number of instances of each target (number)
+
+    Parameters:
+        - counts: the number of instances of each target (iterable of ints)
+        - total: the total number of instances (int)
+    """
+    # The counts are sorted so that equal tables give exactly the same result in any order (the
+    # tables of a node can either be counted or be obtained by subtraction)
+    proportions = [count/total for count in sorted(counts)]
     return sum(-p*log(p, 2) for p in proportions)
 
-def _information_gain(dataset, attribute_name):
+def _information_gain_from_table(contingency_table, entropy, total):
+    """
+    Return the information gain of a split, given its contingency table (number)
+
+    Parameters:
+        - contingency_table: the number of instances for each pair of attribute value and target
+          value ({(int, int): int})
+        - entropy: the entropy of the instances before the split (number)
+        - total: the total number of instances (int)
+    """
+    T = {}
+    for (attribute_code, _), count in contingency_table.items():
+        T.setdefault(attribute_code, []).append(count)
+    return entropy - sum(_entropy_from_counts(T[attribute_code], sum(T[attribute_code]))
+                         * sum(T[attribute_code])/total for attribute_code in sorted(T))
+
+def _weighted_entropy(counts):
     """
-    Return the measure of the difference in entropy from before to after the dataset is split on the
-    given attribute (in other words, how much uncertainty in the dataset was reduced after splitting
-    the dataset on the given attribute) (number)
+    Return the entropy of a distribution multiplied by its number of instances (number)
 
     Parameters:
-        - dataset: the dataset on which the information gain has to be computed (Dataset)
-        - attribute_name: the name of the attribute with which the information gain has to be
-          computed (String)
+        - counts: the number of instances of each target, possibly zero (list of ints)
     """
-    T = set()
-    attribute_values = dataset.get_attribute_values(attribute_name)
-    for attribute_value in attribute_values:
-        t = copy_dataset(dataset, attribute={"name": attribute_name, "value": attribute_value})
-        T.add(t)
-    return _entropy(dataset) - sum(_entropy(t)*t.count_instances()/dataset.count_instances()
-                                   for t in T)
+    total = sum(counts)
+    if total == 0:
+        return 0
+    return total*_entropy_from_counts([count for count in counts if count > 0], total)
@@ -1,27 +1,118 @@
+from array import array
 from collections import Counter
+from itertools import compress
+from operator import countOf
+
+
+# Typecodes used to store the encoded columns, from the most compact to the widest one, together
+# with the largest code each of them can hold
+_TYPECODES = (("B", 0xFF), ("H", 0xFFFF), ("I", 0xFFFFFFFF))
+_MAX_CODES = dict(_TYPECODES)
+
+
+class Vocabulary:
+    """
+    Class that represents the mapping between the values of a categorical column and the integer
+    codes used to store them
+    """
+
+    # CONSTRUCTOR
+    def __init__(self, values=None):
+        """
+        Build a new vocabulary
+
+        Parameters:
+            - values: values that have to be encoded, in the order of their codes, default to None
+              (list of values)
+        """
+        self.values = []
+        self.codes = {}
+        if values is not None:
+            for value in values:
+                self.encode(value)
+
+    # OBJECT REPRESENTATION
+    def __repr__(self):
+        """
+        Return a printable representation of the object (String)
+        """
+        return "Vocabulary(" + str(self.values) + ")"
+
+    def __len__(self):
+        return len(self.values)
+
+    # GETTERS
+    def get_code(self, value):
+        """
+        Return the code associated to the value, None if the value is unknown (int)
+
+        Parameters:
+            - value: the value whose code is desired (value)
+        """
+        return self.codes.get(value)
+
+    def get_value(self, code):
+        """
+        Return the value associated to the code (value)
+
+        Parameters:
+            - code: the code whose value is desired (int)
+        """
+        return self.values[code]
+
+    def get_values(self):
+        """
+        Return all the encoded values, in the order of their codes (list of values)
+        """
+        return self.values
+
+    # SETTERS
+    def encode_values(self, values):
+        """
+        Return the codes associated to the values, adding to the vocabulary the values that are not
+        known yet (list of ints)
+
+        Parameters:
+            - values: the values that have to be encoded (iterable of values)
+        """
+        values = list(values)
+        codes = list(map(self.codes.get, values))
+        if None in codes:
+            codes = list(map(self.encode, values))
+        return codes
+
+    def encode(self, value):
+        """
+        Return the code associated to the value, adding the value to the vocabulary if it is not
+        known yet (int)
+
+        Parameters:
+            - value: the value that has to be encoded (value)
+        """
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
 
 
 class DatasetInstance:
     """
-    Class that represents an instance of a dataset
+    Class that represents an instance of a dataset (a view on a row of the dataset)
     """
 
     # CONSTRUCTOR
-    def __init__(self, attributes_names, attributes_values, target_name, target_value):
+    def __init__(self, dataset, index):
         """
         Build a new instance
 
         Parameters:
-            - attributes_names: names of the attributes (list of Strings)
-            - attributes_values: values of the attributes (list of values)
-            - target_name: the name of the target (String)
-            - target_value: target value (value)
+            - dataset: the dataset that contains the instance (Dataset)
+            - index: the index of the instance in the dataset (int)
         """
-        self.attributes = {}
-        for index, name in enumerate(attributes_names):
-            self.attributes[name] = attributes_values[index]
-        self.target_name = target_name
-        self.target_value = target_value
+        self.dataset = dataset
+        self.index = index
 
     # OBJECT REPRESENTATION
     def __repr__(self):
@@ -29,10 +120,10 @@ class DatasetInstance:
         Return a printable representation of the object (String)
         """
         instance_representation = ""
-        for attribute_name in self.attributes:
+        for attribute_name in self.dataset.get_attributes_names():
             instance_representation += "{}={},".format(str(attribute_name),
-                                                       str(self.attributes[attribute_name]))
-        instance_representation += str(self.target_name) + "(target)=" + str(self.target_value)
+                                                       str(self.get_attribute_value(attribute_name)))
+        instance_representation += str(self.get_target_name()) + "(target)=" + str(self.get_target_value())
         return instance_representation
 
     # GETTERS
@@ -43,38 +134,54 @@ class DatasetInstance:
         Parameters:
             - attribute_name: the name of the desired attribute
         """
-        return self.attributes[attribute_name]
+        attribute_index = self.dataset.attributes_indexes[attribute_name]
+        return self.dataset.vocabularies[attribute_index].get_value(
+            self.dataset.columns[attribute_index][self.index])
 
     def get_target_name(self):
         """
         Return the name of the target (String)
         """
-        return self.target_name
+        return self.dataset.get_target_name()
 
     def get_target_value(self):
         """
         Return the value of the target (value)
         """
-        return self.target_value
+        return self.dataset.target_vocabulary.get_value(self.dataset.target[self.index])
 
 
 class Dataset:
     """
     Class that represents a dataset
+
+    Every attribute (and the target) is stored as a column of small integer codes, while the
+    related vocabulary maps the codes back to the original values.
     """
 
     # CONSTRUCTOR
-    def __init__(self, attributes_names, target_name):
+    def __init__(self, attributes_names, target_name, vocabularies=None, target_vocabulary=None):
         """
         Build a new empty dataset
 
         Parameters:
             - attributes_names: names of the attributes (list of Strings)
             - target_name: name of the target (String)
+            - vocabularies: vocabularies used to encode the attributes, in the same order of the
+              names, default to None (list of Vocabulary)
+            - target_vocabulary: vocabulary used to encode the target, default to None (Vocabulary)
         """
         self.attributes_names = attributes_names
         self.target_name = target_name
-        self.instances = []
+        self.attributes_indexes = {name: index for index, name in enumerate(attributes_names)}
+        if vocabularies is None:
+            vocabularies = [Vocabulary() for _ in attributes_names]
+        if target_vocabulary is None:
+            target_vocabulary = Vocabulary()
+        self.vocabularies = vocabularies
+        self.target_vocabulary = target_vocabulary
+        self.columns = [array(_TYPECODES[0][0]) for _ in attributes_names]
+        self.target = array(_TYPECODES[0][0])
 
     # OBJECT REPRESENTATION
     def __repr__(self):
@@ -88,7 +195,15 @@ class Dataset:
 
     # ITERATOR
     def __iter__(self):
-        return iter(self.instances)
+        return (DatasetInstance(self, index) for index in range(len(self.target)))
+
+    # SERIALIZATION
+    def __getstate__(self):
+        # Memory-mapped columns cannot be pickled, so they are copied into arrays
+        state = dict(self.__dict__)
+        state["columns"] = [array(_get_typecode(column), column) for column in self.columns]
+        state["target"] = array(_get_typecode(self.target), self.target)
+        return state
 
     # GETTERS
     def get_attributes_names(self):
@@ -110,7 +225,37 @@ class Dataset:
         Parameters:
             - index: the index of the desired instance (int)
         """
-        return self.instances[index]
+        return DatasetInstance(self, range(len(self.target))[index])
+
+    def get_column(self, attribute_name):
+        """
+        Return the codes of the specified attribute, one for each instance (array of ints)
+
+        Parameters:
+            - attribute_name: the name of the attribute (String)
+        """
+        return self.columns[self.attributes_indexes[attribute_name]]
+
+    def get_vocabulary(self, attribute_name):
+        """
+        Return the vocabulary used to encode the specified attribute (Vocabulary)
+
+        Parameters:
+            - attribute_name: the name of the attribute (String)
+        """
+        return self.vocabularies[self.attributes_indexes[attribute_name]]
+
+    def get_target_column(self):
+        """
+        Return the codes of the target, one for each instance (array of ints)
+        """
+        return self.target
+
+    def get_target_vocabulary(self):
+        """
+        Return the vocabulary used to encode the target (Vocabulary)
+        """
+        return self.target_vocabulary
 
     # SETTERS
     def add_instance(self, attributes_values, target_value):
@@ -121,21 +266,38 @@ class Dataset:
             - attributes_values: values of the attributes (list of values)
             - target_value: target value (value)
         """
-        self.instances.append(DatasetInstance(self.attributes_names, attributes_values,
-                                              self.target_name, target_value))
+        for attribute_index, vocabulary in enumerate(self.vocabularies):
+            self.columns[attribute_index] = _extend_codes(self.columns[attribute_index],
+                                                          (vocabulary.encode(attributes_values[attribute_index]),))
+        self.target = _extend_codes(self.target, (self.target_vocabulary.encode(target_value),))
+
+    def extend_columns(self, attributes_columns, target_column):
+        """
+        Add new instances to the dataset, given their values column by column (which is much faster
+        than adding them one at a time)
+
+        Parameters:
+            - attributes_columns: values of the attributes, one iterable for each attribute in the
+              same order of the names (list of iterables of values)
+            - target_column: target values (iterable of values)
+        """
+        for attribute_index, vocabulary in enumerate(self.vocabularies):
+            self.columns[attribute_index] = _extend_codes(
+                self.columns[attribute_index], vocabulary.encode_values(attributes_columns[attribute_index]))
+        self.target = _extend_codes(self.target, self.target_vocabulary.encode_values(target_column))
 
     # AGGREGATORS
     def get_target_values(self):
         """
         Return a set of all the target values in the dataset (set of values)
         """
-        return set(instance.get_target_value() for instance in self)
+        return set(self.target_vocabulary.get_value(code) for code in set(self.target))
 
     def get_most_common_target(self):
         """
         Return the most common target value in the dataset (value)
         """
-        return Counter([instance.get_target_value() for instance in self]).most_common(1)[0][0]
+        return self.target_vocabulary.get_value(Counter(self.target).most_common(1)[0][0])
 
     def get_attribute_values(self, attribute_name):
         """
@@ -144,7 +306,8 @@ class Dataset:
         Parameters:
             - attribute_name: the name of the attribute (String)
         """
-        return set(instance.get_attribute_value(attribute_name) for instance in self)
+        vocabulary = self.get_vocabulary(attribute_name)
+        return set(vocabulary.get_value(code) for code in set(self.get_column(attribute_name)))
 
     def count_instances(self, target=None, attribute=None):
         """
@@ -155,10 +318,41 @@ class Dataset:
             - attribute: object with name of an attribute and the related value, default to None
               ({"name": String, "value": value})
         """
-        return len(self._get_instances(target=target, attribute=attribute))
+        if attribute is None:
+            if target is None:
+                return len(self.target)
+            target_code = self.target_vocabulary.get_code(target)
+            return 0 if target_code is None else countOf(self.target, target_code)
+        return len(self._get_indexes(target=target, attribute=attribute))
 
     # PRIVATE METHODS
     # These methods should not be used outside the module
+    def _get_indexes(self, target=None, attribute=None):
+        """
+        Return the indexes of the instances the dataset contains, subject to some constraints
+        (list of ints)
+
+        Parameters:
+            - target: the value of the target, default to None (value)
+            - attribute: object with name of an attribute and the related value, default to None
+              ({"name": String, "value": value})
+        """
+        indexes = range(len(self.target))
+        if target is not None:
+            target_code = self.target_vocabulary.get_code(target)
+            if target_code is None:
+                return []
+            indexes = list(compress(indexes, map(target_code.__eq__,
+                                                 map(self.target.__getitem__, indexes))))
+        if attribute is not None:
+            attribute_code = self.get_vocabulary(attribute["name"]).get_code(attribute["value"])
+            if attribute_code is None:
+                return []
+            column = self.get_column(attribute["name"])
+            indexes = list(compress(indexes, map(attribute_code.__eq__,
+                                                 map(column.__getitem__, indexes))))
+        return list(indexes)
+
     def _get_instances(self, target=None, attribute=None):
         """
         Return the instances the dataset contains, subject to some constraints
@@ -169,14 +363,8 @@ class Dataset:
             - attribute: object with name of an attribute and the related value, default to None
               ({"name": String, "value": value})
         """
-        instances = [instance for instance in self]
-        if target is not None:
-            instances = [instance for instance in instances
-                         if instance.get_target_value() == target]
-        if attribute is not None:
-            instances = [instance for instance in instances
-                         if instance.get_attribute_value(attribute["name"]) == attribute["value"]]
-        return instances
+        return [DatasetInstance(self, index)
+                for index in self._get_indexes(target=target, attribute=attribute)]
 
 
 # UTILITY FUNCTIONS
@@ -185,18 +373,80 @@ def copy_dataset(dataset, target=None, attribute=None):
     Return a copy of the dataset, taking into account only the instances that satisfy certain
     constraints (Dataset)
 
+    The copy shares the vocabularies of the original dataset, so the codes of the two datasets
+    can be compared directly.
+
     Parameters:
         - target: the value of the target, default to None (value)
         - attribute: object with name of an attribute and the related value, default to None
           ({"name": String, "value": value})
     """
-    instances = dataset._get_instances(target=target, attribute=attribute)
+    indexes = dataset._get_indexes(target=target, attribute=attribute)
     attributes_names = [attribute_name for attribute_name in dataset.get_attributes_names()]
     if attribute is not None:
         attributes_names.remove(attribute["name"])
-    new_dataset = Dataset(attributes_names, dataset.get_target_name())
-    for instance in instances:
-        new_dataset.add_instance([instance.get_attribute_value(attribute_name)
-                                  for attribute_name in attributes_names],
-                                 instance.get_target_value())
+    new_dataset = Dataset(attributes_names, dataset.get_target_name(),
+                          [dataset.get_vocabulary(attribute_name) for attribute_name in attributes_names],
+                          dataset.get_target_vocabulary())
+    new_dataset.columns = [_take(dataset.get_column(attribute_name), indexes)
+                           for attribute_name in attributes_names]
+    new_dataset.target = _take(dataset.get_target_column(), indexes)
+    return new_dataset
+
+
+def filter_dataset(dataset, flags):
+    """
+    Return a copy of the dataset that contains only the instances whose flag is true, sharing the
+    vocabularies of the original dataset (Dataset)
+
+    Parameters:
+        - dataset: the dataset that has to be filtered (Dataset)
+        - flags: one flag for each instance of the dataset (sequence of bools)
+    """
+    new_dataset = Dataset(dataset.get_attributes_names(), dataset.get_target_name(),
+                          dataset.vocabularies, dataset.get_target_vocabulary())
+    new_dataset.columns = [array(_get_typecode(column), compress(column, flags))
+                           for column in dataset.columns]
+    new_dataset.target = array(_get_typecode(dataset.target), compress(dataset.target, flags))
     return new_dataset
+
+
+# PRIVATE FUNCTIONS
+# These functions should not be used outside the module
+def _extend_codes(column, codes):
+    """
+    Return the column after appending the codes, widening its type if some code does not fit
+    (array of ints)
+
+    Parameters:
+        - column: the column to which the codes have to be appended (array of ints)
+        - codes: the codes that have to be appended (sequence of ints)
+    """
+    typecode = _get_typecode(column)
+    max_code = max(codes, default=0)
+    if max_code > _MAX_CODES[typecode]:
+        typecode = next(typecode for typecode, type_max_code in _TYPECODES if max_code <= type_max_code)
+    if not isinstance(column, array) or column.typecode != typecode:
+        # Read-only columns (such as the memory-mapped ones) are copied before being modified
+        column = array(typecode, column)
+    column.extend(codes)
+    return column
+
+def _get_typecode(column):
+    """
+    Return the typecode of the column (String)
+
+    Parameters:
+        - column: the column whose typecode is desired (array or memoryview of ints)
+    """
+    return column.typecode if isinstance(column, array) else column.format
+
+def _take(column, indexes):
+    """
+    Return a new column containing only the codes at the given indexes (array of ints)
+
+    Parameters:
+        - column: the column from which the codes have to be taken (array of ints)
+        - indexes: the indexes of the desired codes (iterable of ints)
+    """
+    return array(_get_typecode(column), map(column.__getitem__, indexes))
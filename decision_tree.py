@@ -1,18 +1,59 @@
+from array import array
+from collections import deque
+from itertools import compress, repeat
+
+from dataset import Vocabulary
+
+
+# Code given to the attribute values that a compiled forest has never seen
+_UNKNOWN_CODE = 0x7FFFFFFF
+# Translation tables that turn a byte into the character "1" if it is equal to the index of the
+# table, into "0" otherwise
+_FLAGS_SELECTORS = [b"0"*code + b"1" + b"0"*(255 - code) for code in range(256)]
+# Translation table that turns the character "1" into the byte 1 and any other byte into 0
+_ONES_SELECTOR = bytes(ord("1")) + b"\x01" + bytes(255 - ord("1"))
+# Translation tables that turn the character "1" into the index of the table plus one and any other
+# byte into 0
+_SHIFTED_CODES_SELECTORS = [bytes(ord("1")) + bytes([code + 1]) + bytes(255 - ord("1"))
+                            for code in range(0x7F)]
+# Translation table that subtracts one from a byte (turning 0 into 255, that is -1 as signed byte)
+_SHIFT_BACK = bytes([0xFF]) + bytes(range(0xFF))
+# Translation table that turns any byte but 0 into 1
+_NONZERO_SELECTOR = bytes(1) + b"\x01"*255
+# Positions of the bits set in each byte
+_BYTES_BITS = [tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+# The instances of a node go down one by one, instead of with bitsets, when their number times the
+# number of instances of the batch is below this: a bitset costs as much as the whole batch, while
+# an instance costs as much as its path (so the smaller the batch, the larger the nodes traversed
+# instance by instance)
+_MAX_LISTED_INSTANCES_BY_BATCH = 2**18
+# Number of bits set in an int (int.bit_count is available since Python 3.10)
+_count_bits = getattr(int, "bit_count", lambda bitset: bin(bitset).count("1"))
+
+
 class DecisionNode:
     """
     Class that represents a decision node of a decision tree
+
+    Several attribute values can be associated to the same child (when the values of the attribute
+    have been grouped), so the distinct children of a node are given by get_children_groups.
     """
 
     # CONSTRUCTOR
-    def __init__(self, decision_attribute_name):
+    def __init__(self, decision_attribute_name, information_gain=None, n_of_instances=None):
         """
         Build a new DecisionNode
 
         Parameters:
             - decision_attribute_name: the name of the attribute on which the decision have to be
               taken (String)
+            - information_gain: the information gain of the split, default to None (number)
+            - n_of_instances: the (weighted) number of training instances that reached the node,
+              default to None (int)
         """
         self.decision_attribute_name = decision_attribute_name
+        self.information_gain = information_gain
+        self.n_of_instances = n_of_instances
         self.children = {}
 
     # GETTERS
@@ -22,6 +63,19 @@ class DecisionNode:
         """
         return self.decision_attribute_name
 
+    def get_information_gain(self):
+        """
+        Return the information gain of the split, None if it is not known (number)
+        """
+        return self.information_gain
+
+    def count_instances(self):
+        """
+        Return the (weighted) number of training instances that reached the node, None if it is not
+        known (int)
+        """
+        return self.n_of_instances
+
     def get_child(self, decision_attribute_value):
         """
         Return the child node associated to the decision attribute value (DecisionNode or EndNode)
@@ -32,6 +86,16 @@ class DecisionNode:
         """
         return self.children[decision_attribute_value]
 
+    def get_children_groups(self):
+        """
+        Return the distinct children of the node, each one with the attribute values associated to
+        it, in the order of their first values (list of (DecisionNode or EndNode, list of values))
+        """
+        groups = {}
+        for decision_attribute_value, node in self.children.items():
+            groups.setdefault(id(node), (node, []))[1].append(decision_attribute_value)
+        return list(groups.values())
+
     # SETTERS
     def add_child(self, decision_attribute_value, node):
         """
@@ -63,3 +127,441 @@ class EndNode:
         Return the target associated to the end node (value)
         """
         return self.target_value
+
+
+class CompiledForest:
+    """
+    Class that represents a forest of decision trees compiled into flat arrays
+
+    Every node of every tree is identified by its position in the arrays. Decision nodes store the
+    index of their attribute and the position of their children in a table indexed by the codes of
+    the attribute values, while end nodes store the code of their target (the codes of the values
+    that share a child point to the same position). The node at position 0 is the end node reached
+    by the instances that a tree is not able to classify. Decision nodes store the information gain
+    of their split and their number of training instances as well (zero if they are not known).
+    """
+
+    # CONSTRUCTOR
+    def __init__(self, attributes_names=None, vocabularies=None, target_vocabulary=None):
+        """
+        Build a new empty compiled forest
+
+        Parameters:
+            - attributes_names: names of the attributes, default to None (list of Strings)
+            - vocabularies: vocabularies used to encode the attributes, in the same order of the
+              names, default to None (list of Vocabulary)
+            - target_vocabulary: vocabulary used to encode the target, default to None (Vocabulary)
+        """
+        self.attributes_names = [] if attributes_names is None else list(attributes_names)
+        if vocabularies is None:
+            vocabularies = [Vocabulary() for _ in self.attributes_names]
+        self.vocabularies = list(vocabularies)
+        self.attributes_indexes = {name: index for index, name in enumerate(self.attributes_names)}
+        self.target_vocabulary = Vocabulary() if target_vocabulary is None else target_vocabulary
+        self.features = array("i", [-1])
+        self.targets = array("i", [-1])
+        self.children_offsets = array("i", [0])
+        self.children_counts = array("i", [0])
+        self.children = array("i")
+        self.roots = array("i")
+        self.gains = array("d", [0.0])
+        self.instances_counts = array("i", [0])
+
+    # GETTERS
+    def count_trees(self):
+        """
+        Return the number of trees of the forest (int)
+        """
+        return len(self.roots)
+
+    def count_nodes(self):
+        """
+        Return the number of nodes of the forest, including the node of the unknown instances (int)
+        """
+        return len(self.features)
+
+    def get_tree(self, tree_index):
+        """
+        Return a tree of the forest, rebuilt from the arrays (DecisionNode or EndNode)
+
+        Parameters:
+            - tree_index: the position of the tree in the forest (int)
+        """
+        nodes = {}
+        # Decision nodes whose children have not been added yet
+        pending = []
+        # These functions should not be used outside the scope of the parent function
+        def _get_node(position):
+            if position not in nodes:
+                if self.features[position] < 0:
+                    target_code = self.targets[position]
+                    nodes[position] = EndNode(None if target_code < 0
+                                              else self.target_vocabulary.get_value(target_code))
+                else:
+                    nodes[position] = DecisionNode(self.attributes_names[self.features[position]],
+                                                   self.gains[position],
+                                                   self.instances_counts[position])
+                    pending.append(position)
+            return nodes[position]
+        root = _get_node(self.roots[tree_index])
+        while pending:
+            position = pending.pop()
+            vocabulary = self.vocabularies[self.features[position]]
+            offset = self.children_offsets[position]
+            for code in range(self.children_counts[position]):
+                if self.children[offset + code] != 0:
+                    nodes[position].add_child(vocabulary.get_value(code),
+                                              _get_node(self.children[offset + code]))
+        return root
+
+    def get_tree_nodes(self, tree_index):
+        """
+        Return the positions of the nodes of a tree (list of ints)
+
+        Parameters:
+            - tree_index: the position of the tree in the forest (int)
+        """
+        tree_nodes = [self.roots[tree_index]]
+        visited = set(tree_nodes)
+        index = 0
+        while index < len(tree_nodes):
+            node = tree_nodes[index]
+            index += 1
+            offset = self.children_offsets[node]
+            for child in self.children[offset:offset + self.children_counts[node]]:
+                if child != 0 and child not in visited:
+                    visited.add(child)
+                    tree_nodes.append(child)
+        return tree_nodes
+
+    # SETTERS
+    def add_tree(self, decision_tree):
+        """
+        Compile a decision tree and add it to the forest
+
+        The nodes of the tree are collected in lists, which are appended to the arrays at once.
+
+        Parameters:
+            - decision_tree: the tree that has to be compiled (DecisionNode or EndNode)
+        """
+        # Positions of the first node and of the first child of the tree in the arrays
+        first_node = len(self.features)
+        first_child = len(self.children)
+        features = [-1]
+        targets = [-1]
+        children_offsets = [0]
+        children_counts = [0]
+        gains = [0.0]
+        instances_counts = [0]
+        children = []
+        encode_target = self.target_vocabulary.encode
+        nodes = [(decision_tree, 0)]
+        while nodes:
+            node, index = nodes.pop()
+            if isinstance(node, EndNode):
+                targets[index] = encode_target(node.get_target_value())
+                continue
+            feature = self._get_feature(node.get_decision_attribute())
+            encode = self.vocabularies[feature].encode
+            if node.get_information_gain() is not None:
+                gains[index] = node.get_information_gain()
+            if node.count_instances() is not None:
+                instances_counts[index] = node.count_instances()
+            groups = [(child, [encode(value) for value in values])
+                      for child, values in node.get_children_groups()]
+            features[index] = feature
+            children_offsets[index] = first_child + len(children)
+            children_counts[index] = max((max(codes) for _, codes in groups), default=-1) + 1
+            offset = len(children)
+            children.extend([0]*children_counts[index])
+            for child, codes in groups:
+                # A child shared by several values is compiled once
+                child_index = len(features)
+                features.append(-1)
+                targets.append(-1)
+                children_offsets.append(0)
+                children_counts.append(0)
+                gains.append(0.0)
+                instances_counts.append(0)
+                for code in codes:
+                    children[offset + code] = first_node + child_index
+                nodes.append((child, child_index))
+        self.roots.append(first_node)
+        self.features.extend(features)
+        self.targets.extend(targets)
+        self.children_offsets.extend(children_offsets)
+        self.children_counts.extend(children_counts)
+        self.gains.extend(gains)
+        self.instances_counts.extend(instances_counts)
+        self.children.extend(children)
+
+    def remove_trees(self, trees_indexes):
+        """
+        Remove some trees from the forest, compacting the arrays (the other trees keep their
+        order)
+
+        Parameters:
+            - trees_indexes: the positions of the trees that have to be removed (iterable of ints)
+        """
+        removed_trees = set(trees_indexes)
+        features, targets, children_offsets, children_counts, children, roots = (
+            [-1], [-1], [0], [0], [], [])
+        gains, instances_counts = [0.0], [0]
+        for tree_index, root in enumerate(self.roots):
+            if tree_index in removed_trees:
+                continue
+            # New position of each node of the tree (a child shared by several values is copied
+            # once)
+            positions = {root: len(features)}
+            nodes = [root]
+            features.append(self.features[root])
+            targets.append(self.targets[root])
+            children_offsets.append(0)
+            children_counts.append(0)
+            gains.append(self.gains[root])
+            instances_counts.append(self.instances_counts[root])
+            roots.append(positions[root])
+            while nodes:
+                node = nodes.pop()
+                if self.features[node] < 0:
+                    continue
+                offset = self.children_offsets[node]
+                children_offsets[positions[node]] = len(children)
+                children_counts[positions[node]] = self.children_counts[node]
+                for child in self.children[offset:offset + self.children_counts[node]]:
+                    if child != 0 and child not in positions:
+                        positions[child] = len(features)
+                        features.append(self.features[child])
+                        targets.append(self.targets[child])
+                        children_offsets.append(0)
+                        children_counts.append(0)
+                        gains.append(self.gains[child])
+                        instances_counts.append(self.instances_counts[child])
+                        nodes.append(child)
+                    children.append(positions[child] if child != 0 else 0)
+        self.features = array("i", features)
+        self.targets = array("i", targets)
+        self.children_offsets = array("i", children_offsets)
+        self.children_counts = array("i", children_counts)
+        self.children = array("i", children)
+        self.roots = array("i", roots)
+        self.gains = array("d", gains)
+        self.instances_counts = array("i", instances_counts)
+
+    # PREDICTION
+    def encode_dataset(self, dataset):
+        """
+        Return the columns of the dataset encoded with the vocabularies of the forest, one for each
+        attribute of the forest (list of sequences of ints)
+
+        Values that the forest has never seen are given a code that no node can follow.
+
+        Parameters:
+            - dataset: the dataset that has to be encoded (Dataset)
+        """
+        columns = []
+        for attribute_index, attribute_name in enumerate(self.attributes_names):
+            vocabulary = self.vocabularies[attribute_index]
+            dataset_vocabulary = dataset.get_vocabulary(attribute_name)
+            if dataset_vocabulary is vocabulary:
+                columns.append(dataset.get_column(attribute_name))
+                continue
+            # Columns whose codes fit in a byte are handled faster by get_leaf_codes
+            typecode, unknown_code = ("B", 0xFF) if len(vocabulary) < 0xFF else ("i", _UNKNOWN_CODE)
+            translation = [vocabulary.get_code(value) for value in dataset_vocabulary.get_values()]
+            translation = [unknown_code if code is None else code for code in translation]
+            columns.append(array(typecode, map(translation.__getitem__,
+                                               dataset.get_column(attribute_name))))
+        return columns
+
+    def get_leaf_codes(self, columns, n_of_instances, instances_flags=None, trees_indexes=None):
+        """
+        Return the target codes that each tree associates to each instance, one array for each tree
+        with one code for each instance (-1 for the instances that the tree is not able to
+        classify) (list of arrays of ints)
+
+        Each tree is traversed once for the whole batch. The instances that reach a node are
+        represented by a bitset (an int whose i-th bit is set if the i-th instance reaches the
+        node), so the children of a decision node are found with a bitwise and between the bitset
+        of the node and the bitset of the instances that have the value of each child (or one of
+        the values, for a child shared by several values). A bitset costs as much as the whole
+        batch, so the nodes reached by few instances (most of the nodes of deep trees) keep the
+        list of their instances instead, and send each one down to its end node.
+
+        Parameters:
+            - columns: the encoded attributes of the instances, as returned by encode_dataset
+              (list of sequences of ints)
+            - n_of_instances: the number of instances (int)
+            - instances_flags: whether each instance has to be classified, default to None (all the
+              instances are classified, the others get the code -1) (sequence of bools)
+            - trees_indexes: the positions of the trees that have to classify the instances, one
+              array is returned for each of them, default to None (all the trees) (list of ints)
+        """
+        roots = self.roots if trees_indexes is None else [self.roots[index]
+                                                          for index in trees_indexes]
+        if n_of_instances == 0:
+            return [array("i") for _ in roots]
+        features = self.features.tolist()
+        targets = self.targets.tolist()
+        children_offsets = self.children_offsets.tolist()
+        children_counts = self.children_counts.tolist()
+        children = self.children.tolist()
+        instances_counts = self.instances_counts.tolist()
+        nodes_children = {}
+        values_bitsets = {}
+        leaf_codes = []
+        if instances_flags is None:
+            instances_bitset = (1 << n_of_instances) - 1
+        else:
+            instances_bitset = _get_bitset(bytes(map(bool, instances_flags)), 1)
+        n_of_batch_instances = _count_bits(instances_bitset)
+        min_bitset_instances = _MAX_LISTED_INSTANCES_BY_BATCH/n_of_batch_instances
+        for root in roots:
+            # The instances that reach a node are estimated from the training instances that
+            # reached it, when they are known, since counting the bits costs as much as the batch
+            instances_scale = (n_of_batch_instances/instances_counts[root]
+                               if instances_counts[root] > 0 else None)
+            targets_bitsets = {}
+            nodes = [(root, instances_bitset)]
+            # Nodes reached by few instances, with the list of their instances
+            small_nodes = []
+            while nodes:
+                node, bitset = nodes.pop()
+                feature = features[node]
+                if feature < 0:
+                    targets_bitsets[targets[node]] = targets_bitsets.get(targets[node], 0) | bitset
+                    continue
+                if node not in nodes_children:
+                    offset = children_offsets[node]
+                    codes_children = {}
+                    for code in range(children_counts[node]):
+                        if children[offset + code] != 0:
+                            codes_children.setdefault(children[offset + code], []).append(code)
+                    nodes_children[node] = [(tuple(codes), child)
+                                            for child, codes in codes_children.items()]
+                for codes, child in nodes_children[node]:
+                    if (feature, codes) not in values_bitsets:
+                        values_bitsets[(feature, codes)] = _get_bitset(columns[feature], *codes)
+                    child_bitset = bitset & values_bitsets[(feature, codes)]
+                    if not child_bitset:
+                        continue
+                    # The end nodes are reached by bitsets anyway, as they just collect them
+                    if features[child] >= 0 and (
+                            instances_counts[child]*instances_scale < min_bitset_instances
+                            if instances_scale is not None
+                            else _count_bits(child_bitset) < min_bitset_instances):
+                        small_nodes.append((child, _get_indexes(child_bitset)))
+                    else:
+                        nodes.append((child, child_bitset))
+            # Each instance of a small node goes down on its own, as in a row by row traversal
+            instances_targets = []
+            for node, indexes in small_nodes:
+                for index in indexes:
+                    instance_node = node
+                    feature = features[instance_node]
+                    while feature >= 0:
+                        # The unknown codes are larger than the codes of the children
+                        code = columns[feature][index]
+                        instance_node = (children[children_offsets[instance_node] + code]
+                                         if code < children_counts[instance_node] else 0)
+                        feature = features[instance_node]
+                    instances_targets.append((index, targets[instance_node]))
+            for _, target_code in instances_targets:
+                # The array of the codes has to be large enough for these target codes as well
+                targets_bitsets.setdefault(target_code, 0)
+            codes = _get_codes(targets_bitsets, n_of_instances)
+            for index, target_code in instances_targets:
+                codes[index] = target_code
+            leaf_codes.append(codes)
+        return leaf_codes
+
+    # PRIVATE METHODS
+    # These methods should not be used outside the class
+    def _get_feature(self, attribute_name):
+        """
+        Return the index of the attribute, adding it to the forest if it is not known yet (int)
+
+        Parameters:
+            - attribute_name: the name of the attribute (String)
+        """
+        if attribute_name not in self.attributes_indexes:
+            self.attributes_indexes[attribute_name] = len(self.attributes_names)
+            self.attributes_names.append(attribute_name)
+            self.vocabularies.append(Vocabulary())
+        return self.attributes_indexes[attribute_name]
+
+
+# PRIVATE FUNCTIONS
+# These functions should not be used outside the module
+def _get_bitset(column, code, *codes):
+    """
+    Return the bitset of the instances whose value is equal to the code, or to any of the codes
+    (int)
+
+    Parameters:
+        - column: the encoded values of an attribute (sequence of ints)
+        - code: the code of the value (int)
+        - codes: the codes of other values (ints)
+    """
+    if codes:
+        # The column is scanned once, whatever the number of codes
+        codes = frozenset(codes).union([code])
+        if memoryview(column).itemsize == 1:
+            selector = bytes(ord("1") if byte in codes else ord("0") for byte in range(256))
+            flags = bytes(column).translate(selector)
+        else:
+            flags = bytes(map(codes.__contains__, column)).translate(_FLAGS_SELECTORS[1])
+    elif memoryview(column).itemsize == 1:
+        flags = bytes(column).translate(_FLAGS_SELECTORS[code])
+    else:
+        flags = bytes(map(code.__eq__, column)).translate(_FLAGS_SELECTORS[1])
+    # The first instance has to be the least significant bit
+    return int(flags[::-1], 2)
+
+def _get_indexes(bitset):
+    """
+    Return the positions of the bits set in a bitset, in ascending order (list of ints)
+
+    Parameters:
+        - bitset: the bitset (int)
+    """
+    bitset_bytes = bitset.to_bytes((bitset.bit_length() + 7) // 8, "little")
+    # Only the bytes that contain some bit set are decoded
+    flags = bitset_bytes.translate(_NONZERO_SELECTOR)
+    indexes = []
+    position = flags.find(1)
+    while position >= 0:
+        indexes.extend(8*position + bit for bit in _BYTES_BITS[bitset_bytes[position]])
+        position = flags.find(1, position + 1)
+    return indexes
+
+def _get_codes(targets_bitsets, n_of_instances):
+    """
+    Return the target code of each instance, given the bitset of the instances associated to each
+    target code (-1 for the instances without target) (array of ints)
+
+    Parameters:
+        - targets_bitsets: the bitset of the instances associated to each target code
+          ({int: int})
+        - n_of_instances: the number of instances (int)
+    """
+    targets_bitsets = {target_code: bitset for target_code, bitset in targets_bitsets.items()
+                       if target_code != -1}
+    if max(targets_bitsets, default=-1) < 0x7F:
+        # Every instance gets a byte equal to its target code plus one (zero if it has no target),
+        # which is then read as a signed byte after subtracting one
+        shifted_codes = 0
+        for target_code, bitset in targets_bitsets.items():
+            # The binary representation starts from the last instance
+            flags = format(bitset, "0{}b".format(n_of_instances)).encode()
+            shifted_codes |= int.from_bytes(flags.translate(_SHIFTED_CODES_SELECTORS[target_code]),
+                                            "big")
+        codes = array("b")
+        codes.frombytes(shifted_codes.to_bytes(n_of_instances, "little").translate(_SHIFT_BACK))
+        return codes
+    codes = array("i", [-1]) * n_of_instances
+    for target_code, bitset in targets_bitsets.items():
+        flags = format(bitset, "0{}b".format(n_of_instances))[::-1].encode()
+        deque(map(codes.__setitem__, compress(range(n_of_instances), flags.translate(_ONES_SELECTOR)),
+                  repeat(target_code)), maxlen=0)
+    return codes
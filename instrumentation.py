@@ -0,0 +1,322 @@
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from threading import Lock
+
+from decision_tree import EndNode
+
+try:
+    import resource
+except ImportError:
+    # The peak memory usage can not be measured on this platform
+    resource = None
+
+
+# Profiler that is recording the metrics, None if the instrumentation is disabled
+_profiler = None
+
+
+class Profiler:
+    """
+    Class that collects the metrics of training and inference: the wall time of each phase, some
+    counters, the statistics of each tree and the inference throughput
+
+    Hooks are functions called with the name of an event ("phase", "tree" or "inference") and its
+    data (dict) as soon as the event is recorded, so that the metrics can be sent to external
+    collectors.
+    """
+
+    # CONSTRUCTOR
+    def __init__(self):
+        """
+        Build a new Profiler without metrics
+        """
+        self.phases = {}
+        self.counters = {}
+        self.trees = []
+        self.inference = {"calls": 0, "rows": 0, "seconds": 0.0}
+        self.hooks = []
+        # The counters are increased by the threads that build a tree as well
+        self.counters_lock = Lock()
+
+    # GETTERS
+    def get_metrics(self):
+        """
+        Return all the metrics collected by the profiler ({String: value})
+        """
+        inference = dict(self.inference)
+        inference["rows_per_second"] = (inference["rows"]/inference["seconds"]
+                                        if inference["seconds"] > 0 else None)
+        return {"phases": {name: dict(phase) for name, phase in self.phases.items()},
+                "counters": dict(self.counters),
+                "trees": [dict(tree_statistics) for tree_statistics in self.trees],
+                "inference": inference,
+                "peak_rss_kb": get_peak_rss()}
+
+    # SETTERS
+    def add_hook(self, hook):
+        """
+        Add a function that has to be called whenever an event is recorded
+
+        Parameters:
+            - hook: the function, called with the name of the event and its data (function)
+        """
+        self.hooks.append(hook)
+
+    def add_phase(self, name, seconds, calls=1):
+        """
+        Add the wall time spent in a phase
+
+        Parameters:
+            - name: the name of the phase (String)
+            - seconds: the time spent in the phase (number)
+            - calls: the number of times the phase has been entered, default to 1 (int)
+        """
+        phase = self.phases.setdefault(name, {"calls": 0, "seconds": 0.0})
+        phase["calls"] += calls
+        phase["seconds"] += seconds
+        self._notify("phase", {"name": name, "seconds": seconds, "calls": calls})
+
+    def add_count(self, name, value=1):
+        """
+        Increase a counter
+
+        Parameters:
+            - name: the name of the counter (String)
+            - value: the increase of the counter, default to 1 (number)
+        """
+        with self.counters_lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_tree(self, tree_statistics):
+        """
+        Add the statistics of a trained tree
+
+        Parameters:
+            - tree_statistics: the statistics of the tree ({String: value})
+        """
+        self.trees.append(tree_statistics)
+        self._notify("tree", tree_statistics)
+
+    def add_inference(self, n_of_rows, seconds):
+        """
+        Add a batch of classified instances
+
+        Parameters:
+            - n_of_rows: the number of classified instances (int)
+            - seconds: the time spent classifying them (number)
+        """
+        self.inference["calls"] += 1
+        self.inference["rows"] += n_of_rows
+        self.inference["seconds"] += seconds
+        self._notify("inference", {"rows": n_of_rows, "seconds": seconds})
+
+    def merge(self, metrics):
+        """
+        Add the metrics collected by another profiler (for instance, the one of a worker process)
+
+        Parameters:
+            - metrics: the metrics, as returned by get_metrics ({String: value})
+        """
+        for name, phase in metrics["phases"].items():
+            self.add_phase(name, phase["seconds"], phase["calls"])
+        for name, value in metrics["counters"].items():
+            self.add_count(name, value)
+        for tree_statistics in metrics["trees"]:
+            self.add_tree(tree_statistics)
+        if metrics["inference"]["calls"] > 0:
+            self.add_inference(metrics["inference"]["rows"], metrics["inference"]["seconds"])
+
+    def save(self, filename):
+        """
+        Write the metrics in a JSON file
+
+        Parameters:
+            - filename: name of the file where the metrics have to be written (String)
+        """
+        with open(filename, "w") as metrics_file:
+            json.dump(self.get_metrics(), metrics_file, indent=2)
+
+    # PRIVATE METHODS
+    # These methods should not be used outside the class
+    def _notify(self, event, data):
+        """
+        Call the hooks for an event
+
+        Parameters:
+            - event: the name of the event (String)
+            - data: the data of the event ({String: value})
+        """
+        for hook in self.hooks:
+            hook(event, data)
+
+
+# PUBLIC FUNCTIONS
+def enable(profiler=None):
+    """
+    Start recording the metrics of the current process and return the profiler that records them
+    (Profiler)
+
+    Parameters:
+        - profiler: the profiler that has to record the metrics, default to None (a new one)
+          (Profiler)
+    """
+    global _profiler
+    _profiler = Profiler() if profiler is None else profiler
+    return _profiler
+
+def disable():
+    """
+    Stop recording the metrics and return the profiler that recorded them, None if the
+    instrumentation was not enabled (Profiler)
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+def get_profiler():
+    """
+    Return the profiler that is recording the metrics, None if the instrumentation is disabled
+    (Profiler)
+    """
+    return _profiler
+
+def phase(name):
+    """
+    Return a context manager that adds the time spent in its block to a phase, doing nothing when
+    the instrumentation is disabled (context manager)
+
+    Parameters:
+        - name: the name of the phase (String)
+    """
+    if _profiler is None:
+        return nullcontext()
+    return _timed(_profiler.add_phase, name)
+
+def inference(n_of_rows):
+    """
+    Return a context manager that records the instances classified in its block, doing nothing
+    when the instrumentation is disabled (context manager)
+
+    Parameters:
+        - n_of_rows: the number of instances classified in the block (int)
+    """
+    if _profiler is None:
+        return nullcontext()
+    profiler = _profiler
+    # These functions should not be used outside the scope of the parent function
+    def _add_inference(seconds):
+        profiler.add_phase("classify", seconds)
+        profiler.add_inference(n_of_rows, seconds)
+    return _timed(_add_inference)
+
+def count(name, value=1):
+    """
+    Increase a counter, if the instrumentation is enabled
+
+    Parameters:
+        - name: the name of the counter (String)
+        - value: the increase of the counter, default to 1 (number)
+    """
+    if _profiler is not None:
+        _profiler.add_count(name, value)
+
+def start_tree():
+    """
+    Return what is needed to compute the statistics of a tree that is going to be trained, None if
+    the instrumentation is disabled (tuple)
+
+    When tracemalloc is tracing, its peak is reset, so that the peak memory of the tree can be
+    measured.
+    """
+    if _profiler is None:
+        return None
+    start_memory = None
+    if tracemalloc.is_tracing() and hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+    return time.perf_counter(), dict(_profiler.counters), start_memory
+
+def add_tree(decision_tree, start):
+    """
+    Record the statistics of a trained tree, if the instrumentation is enabled
+
+    The peak memory of the tree (the highest amount of memory allocated by Python while it was
+    trained, on top of the one already allocated) is only measured when tracemalloc is tracing;
+    the peak resident set size is the one of the whole process since it started.
+
+    Parameters:
+        - decision_tree: the trained tree (DecisionNode or EndNode)
+        - start: the value returned by start_tree before the tree was trained (tuple)
+    """
+    if _profiler is None or start is None:
+        return
+    start_time, start_counters, start_memory = start
+    tree_statistics = get_tree_statistics(decision_tree)
+    tree_statistics["seconds"] = time.perf_counter() - start_time
+    for name in ["split_evaluations", "rows_scanned"]:
+        tree_statistics[name] = _profiler.counters.get(name, 0) - start_counters.get(name, 0)
+    if start_memory is not None and tracemalloc.is_tracing():
+        tree_statistics["peak_traced_kb"] = (tracemalloc.get_traced_memory()[1]
+                                             - start_memory) // 1024
+    tree_statistics["process_peak_rss_kb"] = get_peak_rss()
+    _profiler.add_tree(tree_statistics)
+
+def get_tree_statistics(decision_tree):
+    """
+    Return the number of nodes, the number of end nodes and the depth of a tree ({String: int})
+
+    Parameters:
+        - decision_tree: the tree (DecisionNode or EndNode)
+    """
+    n_of_nodes = 0
+    n_of_leaves = 0
+    depth = 0
+    nodes = [(decision_tree, 0)]
+    while nodes:
+        node, node_depth = nodes.pop()
+        n_of_nodes += 1
+        depth = max(depth, node_depth)
+        if isinstance(node, EndNode):
+            n_of_leaves += 1
+            continue
+        nodes.extend((child, node_depth + 1) for child, _ in node.get_children_groups())
+    return {"nodes": n_of_nodes, "leaves": n_of_leaves, "depth": depth}
+
+def get_peak_rss(include_children=False):
+    """
+    Return the peak resident set size of the current process in KiB, None if it can not be
+    measured (int)
+
+    Parameters:
+        - include_children: whether the largest peak of the child processes that have been waited
+          for has to be added, default to False (bool)
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if include_children:
+        peak_rss += resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # macOS measures it in bytes
+    return peak_rss // 1024 if sys.platform == "darwin" else peak_rss
+
+
+# PRIVATE FUNCTIONS
+# These functions should not be used outside the module
+@contextmanager
+def _timed(record, *args):
+    """
+    Return a context manager that passes the time spent in its block to a function (context
+    manager)
+
+    Parameters:
+        - record: the function called with the arguments followed by the time (function)
+        - args: the first arguments of the function
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(*args, time.perf_counter() - start)
@@ -1,45 +1,172 @@
 import argparse
+import random
 
-from utilities import get_dataset, export_graphviz
-from classifiers import random_forest, random_forest_classify, get_feature_importances, get_accuracy
+import instrumentation
+from utilities import get_dataset, export_graphviz, save_forest, load_forest
+from classifiers import (random_forest, grow_forest, random_forest_classify, compile_forest,
+                         get_feature_importances, get_permutation_importances, get_accuracy)
 
-# Define the arguments you can use when you run the program from a console
-parser = argparse.ArgumentParser(description="Run the random forest algorithm, using a given CSV dataset.",
-                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument("-d", "--dataset", required=True, help="Path of the CSV dataset",
-                    dest="dataset")
-parser.add_argument("-l", "--label", required=True, help="The name of the label attribute",
-                    dest="label_name")
-parser.add_argument("-od", "--output-directory", required=False, default=".",
-                    help="Path of the directory where the results have to be saved",
-                    dest="output_directory")
-parser.add_argument("-tf", "--training-fraction", required=False, type=float, default=0.8,
-                    help="The fraction of records reserved for the training dataset (the fraction of records reserved for the test dataset will be set accordingly)",
-                    dest="training_fraction")
-parser.add_argument("-nt", "--number-of-trees", required=False, type=int, default=10,
-                    help="Number of trees that have to be trained", dest="number_of_trees")
-parser.add_argument("-f", "--features", required=False, type=int, default=None,
-                    help="Number of features to consider when looking for the best split",
-                    dest="max_features")
-#parser.add_argument("-s", "--seed", required=False, type=int,
-#                    help="Number used to initialize the internal state of the random number generator",
-#                    dest="seed")
-args = parser.parse_args()
 
-train_dataset, test_dataset = get_dataset(args.dataset, args.label_name, args.training_fraction)
-forest = random_forest(train_dataset, args.number_of_trees, args.max_features)
-for index, decision_tree in enumerate(forest):
-    export_graphviz(str(args.output_directory) + "/tree" + str(index) + ".dot", decision_tree)
-predictions = random_forest_classify(forest, test_dataset)
-feature_importances = get_feature_importances(forest)
-accuracy = get_accuracy(test_dataset, predictions)
+def main():
+    """
+    Train a random forest on a CSV dataset, as requested by the arguments of the command line, and
+    write the results in the output directory
+    """
+    # Define the arguments you can use when you run the program from a console
+    parser = argparse.ArgumentParser(description="Run the random forest algorithm, using a given CSV dataset.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-d", "--dataset", required=True, help="Path of the CSV dataset",
+                        dest="dataset")
+    parser.add_argument("-l", "--label", required=True, help="The name of the label attribute",
+                        dest="label_name")
+    parser.add_argument("-od", "--output-directory", required=False, default=".",
+                        help="Path of the directory where the results have to be saved",
+                        dest="output_directory")
+    parser.add_argument("-tf", "--training-fraction", required=False, type=float, default=0.8,
+                        help="The fraction of records reserved for the training dataset (the fraction of records reserved for the test dataset will be set accordingly)",
+                        dest="training_fraction")
+    parser.add_argument("-nt", "--number-of-trees", required=False, type=int, default=10,
+                        help="Number of trees that have to be trained", dest="number_of_trees")
+    parser.add_argument("-f", "--features", required=False, type=int, default=None,
+                        help="Number of features to consider when looking for the best split",
+                        dest="max_features")
+    parser.add_argument("-s", "--seed", required=False, type=int, default=None,
+                        help="Number used to initialize the internal state of the random number generator",
+                        dest="seed")
+    parser.add_argument("-j", "--jobs", required=False, type=int, default=1,
+                        help="Number of processes used to train the trees (-1 to use all the CPU cores)",
+                        dest="n_jobs")
+    parser.add_argument("--no-cache", required=False, action="store_false",
+                        help="Read the CSV dataset without using (or writing) its binary cache",
+                        dest="cache")
+    parser.add_argument("-md", "--max-depth", required=False, type=int, default=None,
+                        help="Maximum depth of the trees", dest="max_depth")
+    parser.add_argument("-mss", "--min-samples-split", required=False, type=int, default=2,
+                        help="Minimum number of instances that a node needs to be split",
+                        dest="min_samples_split")
+    parser.add_argument("-msl", "--min-samples-leaf", required=False, type=int, default=1,
+                        help="Minimum number of instances of each child of a split",
+                        dest="min_samples_leaf")
+    parser.add_argument("-mig", "--min-information-gain", required=False, type=float, default=None,
+                        help="Minimum information gain of a split", dest="min_information_gain")
+    parser.add_argument("-mln", "--max-leaf-nodes", required=False, type=int, default=None,
+                        help="Maximum number of end nodes of each tree", dest="max_leaf_nodes")
+    parser.add_argument("-g", "--growth", required=False, choices=["depth-first", "best-first"],
+                        default="depth-first",
+                        help="Order in which the nodes of the trees are split (best-first splits the nodes with the highest information gain first)",
+                        dest="growth")
+    parser.add_argument("-nth", "--threads", required=False, type=int, default=1,
+                        help="Number of threads that score the attributes of the large nodes and build the large subtrees of each tree (only used on a free-threaded build of Python, use --jobs otherwise)",
+                        dest="n_threads")
+    parser.add_argument("-mc", "--max-children", required=False, type=int, default=None,
+                        help="Maximum number of children of a decision node (the values of the attributes with more values are grouped by their target distribution)",
+                        dest="max_children")
+    parser.add_argument("--oob", required=False, action="store_true",
+                        help="Estimate the accuracy on the instances left out by the sample of each tree (the training fraction can then be set to 1)",
+                        dest="oob_score")
+    parser.add_argument("--profile", required=False, action="store_true",
+                        help="Write the time spent in each phase, the statistics of each tree and the inference throughput in profile.json, next to the output file",
+                        dest="profile")
+    parser.add_argument("-m", "--model", required=False, default=None,
+                        help="Path of the file where the trained forest has to be saved (see load_forest)",
+                        dest="model")
+    parser.add_argument("-ws", "--warm-start", required=False, default=None,
+                        help="Path of a saved forest to which the new trees have to be added (only the new trees are trained)",
+                        dest="warm_start")
+    parser.add_argument("-r", "--replace", required=False, choices=["oldest", "worst"],
+                        default=None,
+                        help="Trees of the saved forest that are replaced by the new ones (worst: the ones that classify the fewest training instances correctly)",
+                        dest="replace")
+    parser.add_argument("-pi", "--permutation-importances", required=False, type=int, default=None,
+                        help="Number of times each feature is shuffled to measure the decrease of the test accuracy (permutation importance)",
+                        dest="permutation_repeats")
+    args = parser.parse_args()
+    if args.warm_start is None and args.replace is not None:
+        parser.error("--replace requires --warm-start")
+    if args.warm_start is not None and args.oob_score:
+        parser.error("--oob can not be used with --warm-start")
 
-output = open(str(args.output_directory) + "/output", 'w')
-output.write("DATASET\n")
-output.write("\t" + str(train_dataset.count_instances()) + " training examples\n")
-output.write("\t" + str(test_dataset.count_instances()) + " test examples\n")
-output.write("FEATURE IMPORTANCES\n")
-for index, feature_importance in enumerate(feature_importances):
-    output.write("\t{}) {}: used {} times\n".format(str(index+1), str(feature_importance[0]),
-                                                    str(feature_importance[1])))
-output.write("ACCURACY\n\t" + str(accuracy))
+    if args.profile:
+        instrumentation.enable()
+    random.seed(args.seed)
+    train_dataset, test_dataset = get_dataset(args.dataset, args.label_name, args.training_fraction,
+                                              args.seed, cache=args.cache)
+    tree_parameters = {"max_depth": args.max_depth,
+                       "min_samples_split": args.min_samples_split,
+                       "min_samples_leaf": args.min_samples_leaf,
+                       "min_information_gain": args.min_information_gain,
+                       "max_leaf_nodes": args.max_leaf_nodes,
+                       "growth": args.growth,
+                       "n_threads": args.n_threads,
+                       "max_children": args.max_children}
+    with instrumentation.phase("random_forest"):
+        if args.warm_start is None:
+            forest = random_forest(train_dataset, args.number_of_trees, args.max_features,
+                                   args.n_jobs, args.seed, tree_parameters, args.oob_score)
+        else:
+            forest = grow_forest(load_forest(args.warm_start), train_dataset, args.number_of_trees,
+                                 args.max_features, args.n_jobs, args.seed, tree_parameters,
+                                 args.replace)
+    if args.oob_score:
+        forest, oob_accuracy, oob_counts = forest
+    # A list of trees would be compiled again by every classification, so it is compiled once here
+    if args.warm_start is None:
+        with instrumentation.phase("compile_forest"):
+            compiled_forest = compile_forest(forest, train_dataset)
+    else:
+        compiled_forest = forest
+    if args.model is not None:
+        save_forest(args.model, compiled_forest)
+    with instrumentation.phase("export_graphviz"):
+        # The trees of a grown forest are rebuilt from its arrays
+        decision_trees = (forest if args.warm_start is None
+                          else map(forest.get_tree, range(forest.count_trees())))
+        for index, decision_tree in enumerate(decision_trees):
+            export_graphviz(str(args.output_directory) + "/tree" + str(index) + ".dot",
+                            decision_tree)
+    with instrumentation.phase("feature_importances"):
+        feature_importances = get_feature_importances(compiled_forest)
+        gain_importances = get_feature_importances(compiled_forest, "gain")
+    # There is nothing to shuffle when the whole dataset is used for training
+    if args.permutation_repeats is not None and test_dataset.count_instances() > 0:
+        with instrumentation.phase("permutation_importances"):
+            permutation_importances = get_permutation_importances(compiled_forest, test_dataset,
+                                                                  args.permutation_repeats,
+                                                                  args.n_jobs, args.seed)
+    else:
+        permutation_importances = None
+
+    output = open(str(args.output_directory) + "/output", 'w')
+    output.write("DATASET\n")
+    output.write("\t" + str(train_dataset.count_instances()) + " training examples\n")
+    output.write("\t" + str(test_dataset.count_instances()) + " test examples\n")
+    output.write("FEATURE IMPORTANCES\n")
+    for index, feature_importance in enumerate(feature_importances):
+        output.write("\t{}) {}: used {} times\n".format(str(index+1), str(feature_importance[0]),
+                                                        str(feature_importance[1])))
+    output.write("GAIN IMPORTANCES\n")
+    for index, (feature, importance) in enumerate(gain_importances):
+        output.write("\t{}) {}: {:.6f}\n".format(str(index+1), str(feature), importance))
+    if permutation_importances is not None:
+        output.write("PERMUTATION IMPORTANCES\n")
+        for index, (feature, importance, deviation) in enumerate(permutation_importances):
+            output.write("\t{}) {}: {:.6f} +/- {:.6f}\n".format(str(index+1), str(feature),
+                                                              importance, deviation))
+    if args.oob_score:
+        output.write("OUT-OF-BAG ACCURACY\n\t" + str(oob_accuracy) + "\n")
+        for target_value, (n_of_correct, n_of_instances) in oob_counts.items():
+            output.write("\t{}: {} correct out of {}\n".format(str(target_value), str(n_of_correct),
+                                                              str(n_of_instances)))
+    # There is nothing to test when the whole dataset is used for training
+    if test_dataset.count_instances() > 0:
+        predictions = random_forest_classify(compiled_forest, test_dataset)
+        accuracy = get_accuracy(test_dataset, predictions)
+        output.write("ACCURACY\n\t" + str(accuracy))
+    if args.profile:
+        instrumentation.get_profiler().save(str(args.output_directory) + "/profile.json")
+
+
+# The body runs only when the script is executed, not when the worker processes of a spawned pool
+# import it
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+import argparse
+import csv
+import time
+from array import array
+from itertools import product
+from math import prod
+from multiprocessing import cpu_count, get_all_start_methods, get_context
+from random import getrandbits, Random
+from statistics import mean, pvariance
+
+from classifiers import compile_forest, random_forest, random_forest_classify
+from utilities import get_dataset
+
+
+# Dataset and folds shared with the worker processes that evaluate the configurations
+_shared_folds = None
+# Parameters of a configuration that are passed to random_forest instead of ID3, with their
+# default values
+_FOREST_PARAMETERS = {"n_of_trees": 10, "max_features": None}
+# Columns of the results table that follow the parameters of the configurations
+_RESULTS_COLUMNS = ["mean_accuracy", "accuracy_variance", "folds", "train_seconds", "test_seconds"]
+
+
+# PUBLIC FUNCTIONS
+def get_folds(n_of_instances, n_of_folds=5, seed=None):
+    """
+    Return the training and the test instances of each fold of a k-fold cross-validation, as
+    positions in the dataset (list of (array of ints, array of ints))
+
+    The instances are shuffled and dealt to the folds, whose sizes differ by one at most. Each fold
+    is the test set once, while the other folds form its training set.
+
+    Parameters:
+        - n_of_instances: the number of instances of the dataset (int)
+        - n_of_folds: the number of folds, between 2 and the number of instances, default to 5
+          (int)
+        - seed: the number used to initialize the random number generator that shuffles the
+          instances, default to None (int)
+    """
+    if not 2 <= n_of_folds <= n_of_instances:
+        raise ValueError("The number of folds has to be between 2 and the number of instances: "
+                         "{}".format(n_of_folds))
+    positions = list(range(n_of_instances))
+    Random(seed).shuffle(positions)
+    instances_folds = array("I", bytes(4*n_of_instances))
+    for rank, position in enumerate(positions):
+        instances_folds[position] = rank % n_of_folds
+    return [(array("I", [index for index, fold in enumerate(instances_folds) if fold != fold_index]),
+             array("I", [index for index, fold in enumerate(instances_folds) if fold == fold_index]))
+            for fold_index in range(n_of_folds)]
+
+def get_grid(parameters_values):
+    """
+    Return every combination of the values of the parameters (list of {String: value})
+
+    Parameters:
+        - parameters_values: the values that each parameter can take ({String: list of values})
+    """
+    names = list(parameters_values)
+    return [dict(zip(names, values))
+            for values in product(*[parameters_values[name] for name in names])]
+
+def get_random_configurations(parameters_values, n_of_configurations, seed=None):
+    """
+    Return distinct combinations of the values of the parameters, drawn at random (list of
+    {String: value})
+
+    The combinations are drawn as positions in the grid, which is never built.
+
+    Parameters:
+        - parameters_values: the values that each parameter can take ({String: list of values})
+        - n_of_configurations: the number of combinations, at most the size of the grid (int)
+        - seed: the number used to initialize the random number generator, default to None (int)
+    """
+    names = list(parameters_values)
+    n_of_combinations = prod(len(parameters_values[name]) for name in names)
+    configurations = []
+    for position in Random(seed).sample(range(n_of_combinations),
+                                        min(n_of_configurations, n_of_combinations)):
+        configuration = {}
+        # The last parameter changes fastest, as in get_grid
+        for name in reversed(names):
+            position, value_index = divmod(position, len(parameters_values[name]))
+            configuration[name] = parameters_values[name][value_index]
+        configurations.append({name: configuration[name] for name in names})
+    return configurations
+
+def cross_validate(dataset, configurations, n_of_folds=5, n_jobs=1, seed=None, early_stopping=None):
+    """
+    Return the accuracy of the random forests trained with each configuration, estimated by k-fold
+    cross-validation: the accuracy on each fold, their mean and variance, and the time spent
+    training and classifying (list of {String: value}, in the order of the configurations)
+
+    The dataset is encoded once and the folds are arrays of positions, so no instance is ever
+    copied; the worker processes receive the dataset and the folds only once (forked workers
+    inherit them). All the configurations use the same seed on the same fold, so their accuracies
+    can be compared fold by fold. The jobs (a configuration on a fold) are all run at the same
+    time, unless early_stopping is given: then they are run one fold at a time, and after each fold
+    the configurations whose mean accuracy is lower than the best one by more than early_stopping
+    are not evaluated on the remaining folds. The results do not depend on the number of
+    processes.
+
+    Parameters:
+        - dataset: the dataset used to train and test the forests (Dataset)
+        - configurations: the parameters of each forest: n_of_trees (default to 10), max_features
+          (default to None), and the parameters of ID3 that control the growth of the trees, as in
+          the tree_parameters of random_forest (list of {String: value})
+        - n_of_folds: the number of folds, default to 5 (int)
+        - n_jobs: the number of processes that train and test the forests, -1 to use all the CPU
+          cores, default to 1 (int)
+        - seed: the number used to initialize the random number generators, default to None
+          (int)
+        - early_stopping: the maximum difference between the mean accuracy of a configuration and
+          the best one to keep evaluating it, default to None (every configuration is evaluated
+          on every fold) (number)
+    """
+    global _shared_folds
+    seed_generator = Random(getrandbits(32) if seed is None else seed)
+    folds = get_folds(dataset.count_instances(), n_of_folds, seed_generator.getrandbits(32))
+    folds_seeds = [seed_generator.getrandbits(32) for _ in folds]
+    results = [{"configuration": dict(configuration), "accuracies": [], "train_seconds": 0.0,
+                "test_seconds": 0.0} for configuration in configurations]
+    if n_jobs == -1:
+        n_jobs = cpu_count()
+    # Early stopping waits for the end of each fold, so only the jobs of a fold run together
+    n_of_parallel_jobs = len(configurations)*(n_of_folds if early_stopping is None else 1)
+    _shared_folds = (dataset, folds)
+    try:
+        if n_jobs == 1 or n_of_parallel_jobs <= 1:
+            _run_folds(results, folds_seeds, early_stopping, map)
+        else:
+            if "fork" in get_all_start_methods():
+                pool = get_context("fork").Pool(min(n_jobs, n_of_parallel_jobs))
+            else:
+                pool = get_context().Pool(min(n_jobs, n_of_parallel_jobs),
+                                          initializer=_share_folds, initargs=(_shared_folds,))
+            with pool:
+                _run_folds(results, folds_seeds, early_stopping, pool.map)
+    finally:
+        _shared_folds = None
+    for result in results:
+        result["mean_accuracy"] = mean(result["accuracies"])
+        result["accuracy_variance"] = pvariance(result["accuracies"])
+        result["folds"] = len(result["accuracies"])
+    return results
+
+def format_results(results):
+    """
+    Return the results of a cross-validation as a text table, one row for each configuration, from
+    the most accurate one (String)
+
+    Parameters:
+        - results: the results, as returned by cross_validate (list of {String: value})
+    """
+    names = []
+    for result in results:
+        names.extend(name for name in result["configuration"] if name not in names)
+    rows = [names + _RESULTS_COLUMNS]
+    for result in sorted(results, key=lambda result: result["mean_accuracy"], reverse=True):
+        rows.append([str(result["configuration"].get(name, "")) for name in names] +
+                    ["{:.4f}".format(result["mean_accuracy"]),
+                     "{:.6f}".format(result["accuracy_variance"]), str(result["folds"]),
+                     "{:.2f}".format(result["train_seconds"]),
+                     "{:.2f}".format(result["test_seconds"])])
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    return "\n".join("  ".join(cell.rjust(width) for cell, width in zip(row, widths)).rstrip()
+                     for row in rows)
+
+
+# PRIVATE FUNCTIONS
+# These functions should not be used outside the module
+def _run_folds(results, folds_seeds, early_stopping, map_function):
+    """
+    Evaluate the configurations that have not been stopped on each fold, adding the accuracies
+    and the timings to their results
+
+    Without early stopping, the jobs of every fold are given to the map function at once.
+
+    Parameters:
+        - results: the results of the configurations, as built by cross_validate (list of
+          {String: value})
+        - folds_seeds: the seed of the forests of each fold (list of ints)
+        - early_stopping: the maximum difference between the mean accuracy of a configuration and
+          the best one to keep evaluating it (number)
+        - map_function: the function that applies _evaluate_shared_fold to a list of jobs, in
+          order (function)
+    """
+    if early_stopping is None:
+        jobs = [(result, fold_index, fold_seed) for fold_index, fold_seed in enumerate(folds_seeds)
+                for result in results]
+        jobs_results = map_function(_evaluate_shared_fold,
+                                    [(result["configuration"], fold_index, fold_seed)
+                                     for result, fold_index, fold_seed in jobs])
+        for (result, _, _), (accuracy, train_seconds, test_seconds) in zip(jobs, jobs_results):
+            result["accuracies"].append(accuracy)
+            result["train_seconds"] += train_seconds
+            result["test_seconds"] += test_seconds
+        return
+    running_results = list(results)
+    for fold_index, fold_seed in enumerate(folds_seeds):
+        fold_results = map_function(_evaluate_shared_fold,
+                                    [(result["configuration"], fold_index, fold_seed)
+                                     for result in running_results])
+        for result, (accuracy, train_seconds, test_seconds) in zip(running_results, fold_results):
+            result["accuracies"].append(accuracy)
+            result["train_seconds"] += train_seconds
+            result["test_seconds"] += test_seconds
+        if fold_index < len(folds_seeds) - 1:
+            best_accuracy = max(mean(result["accuracies"]) for result in running_results)
+            running_results = [result for result in running_results
+                               if mean(result["accuracies"]) >= best_accuracy - early_stopping]
+
+def _share_folds(shared_folds):
+    """
+    Store the dataset and the folds used by the jobs run in the current process
+
+    Parameters:
+        - shared_folds: the dataset and its folds, as returned by get_folds ((Dataset, list of
+          (array of ints, array of ints)))
+    """
+    global _shared_folds
+    _shared_folds = shared_folds
+
+def _evaluate_shared_fold(parameters):
+    """
+    Return the accuracy of a random forest trained on the training instances of a fold of the
+    shared dataset and tested on its test instances, the time spent training it and the time
+    spent classifying ((number, number, number))
+
+    Parameters:
+        - parameters: the configuration of the forest, the position of the fold and the seed of
+          the forest (({String: value}, int, int))
+    """
+    configuration, fold_index, seed = parameters
+    dataset, folds = _shared_folds
+    training_indexes, test_indexes = folds[fold_index]
+    tree_parameters = {name: value for name, value in configuration.items()
+                       if name not in _FOREST_PARAMETERS}
+    start = time.perf_counter()
+    forest = random_forest(dataset, configuration.get("n_of_trees", _FOREST_PARAMETERS["n_of_trees"]),
+                           configuration.get("max_features", _FOREST_PARAMETERS["max_features"]),
+                           1, seed, tree_parameters, indexes=training_indexes)
+    train_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    # The forest is compiled with the vocabularies of the dataset, so the columns are used as they
+    # are instead of being encoded again
+    predictions = random_forest_classify(compile_forest(forest, dataset), dataset,
+                                         indexes=test_indexes)
+    target_values = dataset.get_target_vocabulary().get_values()
+    target_column = dataset.get_target_column()
+    n_of_correct = sum(prediction == target_values[target_column[index]]
+                       for prediction, index in zip(predictions, test_indexes))
+    return n_of_correct/len(test_indexes), train_seconds, time.perf_counter() - start
+
+def _write_results(filename, results):
+    """
+    Write the results of a cross-validation in a CSV file, one row for each configuration
+
+    Parameters:
+        - filename: name of the file where the results have to be written (String)
+        - results: the results, as returned by cross_validate (list of {String: value})
+    """
+    names = []
+    for result in results:
+        names.extend(name for name in result["configuration"] if name not in names)
+    with open(filename, "w", newline="") as csv_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(names + _RESULTS_COLUMNS + ["accuracies"])
+        for result in results:
+            csv_writer.writerow([result["configuration"].get(name) for name in names] +
+                                [result[column] for column in _RESULTS_COLUMNS] +
+                                [" ".join(map(str, result["accuracies"]))])
+
+def _parse_list(parse):
+    """
+    Return a function that parses a comma separated list of values (function)
+
+    Parameters:
+        - parse: the function that parses a single value (function)
+    """
+    return lambda text: [parse(value) for value in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare random forest configurations by k-fold cross-validation on a CSV dataset. Every comma separated list defines the values of a parameter: each combination is evaluated (grid search), or only some of them (random search).",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-d", "--dataset", required=True, help="Path of the CSV dataset",
+                        dest="dataset")
+    parser.add_argument("-l", "--label", required=True, help="The name of the label attribute",
+                        dest="label_name")
+    parser.add_argument("-k", "--folds", required=False, type=int, default=5,
+                        help="Number of folds", dest="n_of_folds")
+    parser.add_argument("-nt", "--number-of-trees", required=False, type=_parse_list(int),
+                        default=[10], help="Number of trees of the forests", dest="n_of_trees")
+    parser.add_argument("-f", "--features", required=False, type=_parse_list(int), default=None,
+                        help="Number of features to consider when looking for the best split",
+                        dest="max_features")
+    parser.add_argument("-md", "--max-depth", required=False, type=_parse_list(int), default=None,
+                        help="Maximum depth of the trees", dest="max_depth")
+    parser.add_argument("-mss", "--min-samples-split", required=False, type=_parse_list(int),
+                        default=None, help="Minimum number of instances that a node needs to be split",
+                        dest="min_samples_split")
+    parser.add_argument("-msl", "--min-samples-leaf", required=False, type=_parse_list(int),
+                        default=None, help="Minimum number of instances of each child of a split",
+                        dest="min_samples_leaf")
+    parser.add_argument("-mln", "--max-leaf-nodes", required=False, type=_parse_list(int),
+                        default=None, help="Maximum number of end nodes of each tree",
+                        dest="max_leaf_nodes")
+    parser.add_argument("-mc", "--max-children", required=False, type=_parse_list(int),
+                        default=None, help="Maximum number of children of a decision node",
+                        dest="max_children")
+    parser.add_argument("-rs", "--random-search", required=False, type=int, default=None,
+                        help="Number of combinations drawn at random (default: all of them)",
+                        dest="n_of_configurations")
+    parser.add_argument("-es", "--early-stopping", required=False, type=float, default=None,
+                        help="Stop evaluating a configuration when its mean accuracy is lower than the best one by more than this (default: never)",
+                        dest="early_stopping")
+    parser.add_argument("-s", "--seed", required=False, type=int, default=None,
+                        help="Number used to draw the folds, the combinations and the samples of the trees",
+                        dest="seed")
+    parser.add_argument("-j", "--jobs", required=False, type=int, default=1,
+                        help="Number of processes that train and test the forests (-1 to use all the CPU cores)",
+                        dest="n_jobs")
+    parser.add_argument("--no-cache", required=False, action="store_false",
+                        help="Read the CSV dataset without using (or writing) its binary cache",
+                        dest="cache")
+    parser.add_argument("-o", "--output", required=False, default=None,
+                        help="Path of the CSV file where the results have to be written as well",
+                        dest="output")
+    args = parser.parse_args()
+
+    parameters_values = {name: values for name, values in [
+        ("n_of_trees", args.n_of_trees), ("max_features", args.max_features),
+        ("max_depth", args.max_depth), ("min_samples_split", args.min_samples_split),
+        ("min_samples_leaf", args.min_samples_leaf), ("max_leaf_nodes", args.max_leaf_nodes),
+        ("max_children", args.max_children)] if values is not None}
+    if args.n_of_configurations is None:
+        configurations = get_grid(parameters_values)
+    else:
+        configurations = get_random_configurations(parameters_values, args.n_of_configurations,
+                                                   args.seed)
+    # The whole dataset is encoded once, and split into folds by position
+    dataset, _ = get_dataset(args.dataset, args.label_name, 1, cache=args.cache)
+    results = cross_validate(dataset, configurations, args.n_of_folds, args.n_jobs, args.seed,
+                             args.early_stopping)
+    print(format_results(results))
+    if args.output is not None:
+        _write_results(args.output, results)
@@ -0,0 +1,167 @@
+import argparse
+import csv
+import io
+from collections import deque
+from itertools import islice, repeat
+from multiprocessing import cpu_count, get_context
+from operator import itemgetter
+
+from classifiers import random_forest_classify
+from dataset import Dataset
+from utilities import load_forest
+
+
+# Forest used by the chunks scored in the current process
+_shared_forest = None
+
+
+# PUBLIC FUNCTIONS
+def score_file(model_filename, input_filename, output_filename, chunk_size=10000, n_jobs=1,
+               probabilities=False):
+    """
+    Classify the instances of a CSV file with a saved random forest, and write the predictions in
+    a CSV file in the same order of the instances
+
+    The file is read in chunks, which are classified by a pool of processes. Only a few chunks per
+    process are read ahead of the ones being written, so the memory needed does not depend on the
+    size of the file.
+
+    Parameters:
+        - model_filename: name of the file where the forest has been saved (String)
+        - input_filename: name of the CSV file that contains the instances; it has to contain a
+          column for each attribute of the forest, while the other columns are ignored (String)
+        - output_filename: name of the CSV file where the predictions have to be written (String)
+        - chunk_size: the number of instances classified at a time, default to 10000 (int)
+        - n_jobs: the number of processes used to classify the instances, -1 to use all the CPU
+          cores, default to 1 (int)
+        - probabilities: whether the fraction of trees that vote for each target value has to be
+          written as well, default to False (bool)
+    """
+    global _shared_forest
+    if n_jobs == -1:
+        n_jobs = cpu_count()
+    forest = load_forest(model_filename, memory_map=True)
+    with open(input_filename, newline="") as input_file, \
+            open(output_filename, "w", newline="") as output_file:
+        csv_reader = csv.reader(input_file)
+        fieldnames = next(csv_reader)
+        missing_attributes_names = [attribute_name for attribute_name in forest.attributes_names
+                                    if attribute_name not in fieldnames]
+        if missing_attributes_names:
+            raise ValueError("Missing attributes in {}: {}".format(input_filename,
+                                                                   ", ".join(missing_attributes_names)))
+        # The rows are reduced to the attributes of the forest before being sent to the workers (the
+        # first column is added at the end so that itemgetter returns a tuple even for a single
+        # attribute)
+        attributes_getter = itemgetter(*[fieldnames.index(attribute_name)
+                                         for attribute_name in forest.attributes_names] + [0])
+        records = _read_records(csv_reader, len(fieldnames), input_filename)
+        chunks = (list(map(attributes_getter, rows))
+                  for rows in iter(lambda: list(islice(records, chunk_size)), []))
+        header = ["prediction"]
+        if probabilities:
+            header.extend(str(target_value) for target_value in forest.target_vocabulary.get_values())
+        csv.writer(output_file).writerow(header)
+        if n_jobs == 1:
+            _shared_forest = forest
+            try:
+                for chunk in chunks:
+                    output_file.write(_score_chunk((chunk, probabilities)))
+            finally:
+                _shared_forest = None
+            return
+        with get_context().Pool(n_jobs, initializer=_load_shared_forest,
+                                initargs=(model_filename,)) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_score_chunk, ((chunk, probabilities),)))
+                # The oldest chunk is written before more chunks are read
+                if len(pending) >= 2*n_jobs:
+                    output_file.write(pending.popleft().get())
+            while pending:
+                output_file.write(pending.popleft().get())
+
+
+# PRIVATE FUNCTIONS
+# These functions should not be used outside the module
+def _read_records(csv_reader, n_of_fields, filename):
+    """
+    Return an iterator over the records of a CSV file, skipping the empty lines (iterator of lists
+    of Strings)
+
+    Parameters:
+        - csv_reader: the reader of the file, after the header (csv.reader)
+        - n_of_fields: the number of fields of the header (int)
+        - filename: name of the file, used in the error messages (String)
+    """
+    for row in csv_reader:
+        if not row:
+            continue
+        # A short row would make the attributes getter fail without saying where
+        if len(row) != n_of_fields:
+            raise ValueError("Line {} of {} has {} fields instead of {}".format(
+                csv_reader.line_num, filename, len(row), n_of_fields))
+        yield row
+
+def _load_shared_forest(model_filename):
+    """
+    Load the forest used by the chunks scored in the current process
+
+    Parameters:
+        - model_filename: name of the file where the forest has been saved (String)
+    """
+    global _shared_forest
+    _shared_forest = load_forest(model_filename, memory_map=True)
+
+def _score_chunk(parameters):
+    """
+    Return the predictions of the shared forest for a chunk of instances, as CSV rows (String)
+
+    Parameters:
+        - parameters: the values of the attributes of the forest for each instance (followed by a
+          value that is ignored), and whether the vote fractions have to be written ((list of
+          tuples of Strings, bool))
+    """
+    rows, probabilities = parameters
+    attributes_names = _shared_forest.attributes_names
+    dataset = Dataset(attributes_names, None)
+    columns = list(zip(*rows)) if rows else [() for _ in attributes_names]
+    # The target of the instances is unknown
+    dataset.extend_columns(columns, repeat(None, len(rows)))
+    output = io.StringIO()
+    csv_writer = csv.writer(output)
+    if not probabilities:
+        csv_writer.writerows(zip(random_forest_classify(_shared_forest, dataset)))
+        return output.getvalue()
+    target_values = _shared_forest.target_vocabulary.get_values()
+    predictions, instances_probabilities = random_forest_classify(_shared_forest, dataset, True)
+    csv_writer.writerows([prediction] + [instance_probabilities[target_value]
+                                         for target_value in target_values]
+                         for prediction, instance_probabilities
+                         in zip(predictions, instances_probabilities))
+    return output.getvalue()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Classify the instances of a CSV file with a random forest saved by main.py.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-m", "--model", required=True, help="Path of the saved forest",
+                        dest="model")
+    parser.add_argument("-i", "--input", required=True,
+                        help="Path of the CSV file that contains the instances to classify",
+                        dest="input")
+    parser.add_argument("-o", "--output", required=True,
+                        help="Path of the CSV file where the predictions have to be written",
+                        dest="output")
+    parser.add_argument("-cs", "--chunk-size", required=False, type=int, default=10000,
+                        help="Number of instances classified at a time", dest="chunk_size")
+    parser.add_argument("-j", "--jobs", required=False, type=int, default=1,
+                        help="Number of processes used to classify the instances (-1 to use all the CPU cores)",
+                        dest="n_jobs")
+    parser.add_argument("-p", "--probabilities", required=False, action="store_true",
+                        help="Write the fraction of trees that vote for each target value as well",
+                        dest="probabilities")
+    args = parser.parse_args()
+
+    score_file(args.model, args.input, args.output, args.chunk_size, args.n_jobs,
+               args.probabilities)
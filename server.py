@@ -0,0 +1,320 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from itertools import repeat
+
+from classifiers import random_forest_classify
+from dataset import Dataset
+from utilities import load_forest
+
+
+# Reason phrases of the HTTP status codes used by the server
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            500: "Internal Server Error"}
+
+
+class PredictionServer:
+    """
+    Class that represents an HTTP/JSON service that classifies instances with a random forest
+
+    The instances of the concurrent requests are collected into micro-batches, which are classified
+    at once: a batch is classified as soon as it reaches the maximum number of instances or as soon
+    as its first request has waited for the maximum time.
+
+    Endpoints:
+        - POST /predict: classify the instances of the body, {"instances": [{attribute name:
+          value}], "probabilities": bool}, returning {"predictions": [value]} (and
+          {"probabilities": [{target value: fraction of votes}]} if requested)
+        - GET /stats: return the latency percentiles, the queue depth and the batch sizes
+    """
+
+    # CONSTRUCTOR
+    def __init__(self, forest, max_batch_size=1000, max_wait=0.005, latencies_window=10000):
+        """
+        Build a new PredictionServer
+
+        Parameters:
+            - forest: the random forest that classifies the instances (List of DecisionNode or
+              EndNode, or CompiledForest)
+            - max_batch_size: the maximum number of instances of a batch, default to 1000 (int)
+            - max_wait: the maximum time (in seconds) that a request waits for other requests
+              before its batch is classified, default to 0.005 (number)
+            - latencies_window: the number of recent requests whose latency is used for the
+              percentiles, default to 10000 (int)
+        """
+        self.forest = forest
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.latencies = deque(maxlen=latencies_window)
+        self.queue = None
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.n_of_requests = 0
+        self.n_of_batches = 0
+        self.n_of_batched_instances = 0
+
+    # GETTERS
+    def get_stats(self):
+        """
+        Return the statistics of the server: the 50th and 99th percentiles of the latency of the
+        recent requests (in milliseconds), the number of instances waiting to be classified and its
+        maximum, and the number and mean size of the batches ({String: value})
+        """
+        latencies = sorted(self.latencies)
+        return {"requests": self.n_of_requests,
+                "latency_p50_ms": _get_percentile(latencies, 50),
+                "latency_p99_ms": _get_percentile(latencies, 99),
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "batches": self.n_of_batches,
+                "mean_batch_size": (self.n_of_batched_instances/self.n_of_batches
+                                    if self.n_of_batches > 0 else None)}
+
+    # PREDICTION
+    async def predict(self, instances, probabilities=False):
+        """
+        Return the target values that the forest associates to the instances, and the fraction of
+        trees that vote for each target value if requested (List of values, or (List of values,
+        List of {value: number}))
+
+        Parameters:
+            - instances: the values of the attributes of each instance; missing attributes are
+              treated as unknown values (List of {String: value})
+            - probabilities: whether the fraction of trees that vote for each target value has to
+              be returned as well, default to False (bool)
+        """
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        self.queue_depth += len(instances)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        await self.queue.put((instances, future))
+        predictions, instances_probabilities = await future
+        self.n_of_requests += 1
+        self.latencies.append(1000*(time.perf_counter() - start))
+        if probabilities:
+            return predictions, instances_probabilities
+        return predictions
+
+    async def serve(self, host="127.0.0.1", port=8000):
+        """
+        Accept requests until the task is cancelled
+
+        Parameters:
+            - host: the address on which the server listens, default to "127.0.0.1" (String)
+            - port: the port on which the server listens, default to 8000 (int)
+        """
+        self.queue = asyncio.Queue()
+        batches_task = asyncio.create_task(self._run_batches())
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batches_task.cancel()
+
+    # PRIVATE METHODS
+    # These methods should not be used outside the class
+    async def _run_batches(self):
+        """
+        Collect the queued requests into batches and classify them, forever
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.queue.get()]
+            n_of_instances = len(requests[0][0])
+            deadline = loop.time() + self.max_wait
+            while n_of_instances < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+                n_of_instances += len(requests[-1][0])
+            self.queue_depth -= n_of_instances
+            self.n_of_batches += 1
+            self.n_of_batched_instances += n_of_instances
+            instances = [instance for request_instances, _ in requests
+                         for instance in request_instances]
+            try:
+                # The batch is classified in another thread, so that new requests keep being queued
+                predictions, instances_probabilities = await loop.run_in_executor(
+                    None, self._classify, instances)
+            except Exception:
+                # Each request is classified on its own, so that only the faulty ones fail
+                for request_instances, future in requests:
+                    try:
+                        result = await loop.run_in_executor(None, self._classify,
+                                                            request_instances)
+                    except Exception as exception:
+                        if not future.done():
+                            future.set_exception(exception)
+                        continue
+                    if not future.done():
+                        future.set_result(result)
+                continue
+            start = 0
+            for request_instances, future in requests:
+                end = start + len(request_instances)
+                if not future.done():
+                    future.set_result((predictions[start:end], instances_probabilities[start:end]))
+                start = end
+
+    def _classify(self, instances):
+        """
+        Return the target values that the forest associates to the instances, and the fraction of
+        trees that vote for each target value (List of values, List of {value: number})
+
+        Parameters:
+            - instances: the values of the attributes of each instance (List of {String: value})
+        """
+        attributes_names = _get_attributes_names(self.forest)
+        dataset = Dataset(attributes_names, None)
+        # The target of the instances is unknown
+        dataset.extend_columns([[instance.get(attribute_name) for instance in instances]
+                                for attribute_name in attributes_names],
+                               repeat(None, len(instances)))
+        return random_forest_classify(self.forest, dataset, True)
+
+    async def _handle_connection(self, reader, writer):
+        """
+        Answer the requests received on a connection, until the client closes it
+
+        Parameters:
+            - reader: the stream from which the requests are read (StreamReader)
+            - writer: the stream on which the responses are written (StreamWriter)
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    header_line = await reader.readline()
+                    if header_line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header_line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, response = await self._get_response(method, path, body)
+                content = json.dumps(response).encode()
+                writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n"
+                             "Content-Length: {}\r\n\r\n".format(status, _REASONS[status],
+                                                                 len(content)).encode() + content)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _get_response(self, method, path, body):
+        """
+        Return the status code and the content of the response to a request ((int, dict))
+
+        Parameters:
+            - method: the HTTP method of the request (String)
+            - path: the path of the request (String)
+            - body: the body of the request (bytes)
+        """
+        if path == "/stats":
+            if method != "GET":
+                return 405, {"error": "Use GET"}
+            return 200, self.get_stats()
+        if path != "/predict":
+            return 404, {"error": "Unknown path: {}".format(path)}
+        if method != "POST":
+            return 405, {"error": "Use POST"}
+        try:
+            request = json.loads(body)
+            instances = request["instances"]
+            if not isinstance(instances, list) or not all(isinstance(instance, dict)
+                                                          for instance in instances):
+                raise ValueError("instances has to be a list of objects")
+            # The vocabularies of the forest hold the strings of the CSV file, so any other value
+            # would silently be an unknown one
+            for instance in instances:
+                for attribute_name, value in instance.items():
+                    if not isinstance(value, str):
+                        raise ValueError("the value of {} has to be a string, as in the CSV file: "
+                                         "{}".format(attribute_name, json.dumps(value)))
+        except (ValueError, KeyError, TypeError) as exception:
+            return 400, {"error": "Invalid request: {}".format(exception)}
+        if not instances:
+            return 200, {"predictions": []}
+        try:
+            if request.get("probabilities", False):
+                predictions, instances_probabilities = await self.predict(instances, True)
+                return 200, {"predictions": predictions, "probabilities": [
+                    {str(target_value): probability
+                     for target_value, probability in instance_probabilities.items()}
+                    for instance_probabilities in instances_probabilities]}
+            return 200, {"predictions": await self.predict(instances)}
+        except Exception as exception:
+            return 500, {"error": str(exception)}
+
+
+# PRIVATE FUNCTIONS
+# These functions should not be used outside the module
+def _get_attributes_names(forest):
+    """
+    Return the names of the attributes used by the forest (list of Strings)
+
+    Parameters:
+        - forest: the random forest (List of DecisionNode or EndNode, or CompiledForest)
+    """
+    if hasattr(forest, "attributes_names"):
+        return forest.attributes_names
+    attributes_names = []
+    nodes = list(forest)
+    while nodes:
+        node = nodes.pop()
+        if hasattr(node, "children"):
+            if node.get_decision_attribute() not in attributes_names:
+                attributes_names.append(node.get_decision_attribute())
+            nodes.extend(child for child, _ in node.get_children_groups())
+    return attributes_names
+
+def _get_percentile(sorted_values, percentile):
+    """
+    Return the percentile of the values, using the nearest rank, None if there are no values
+    (number)
+
+    Parameters:
+        - sorted_values: the values, in ascending order (list of numbers)
+        - percentile: the desired percentile, between 0 and 100 (number)
+    """
+    if not sorted_values:
+        return None
+    rank = max(0, -(-percentile*len(sorted_values) // 100) - 1)
+    return sorted_values[int(rank)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the predictions of a random forest saved by main.py over HTTP/JSON.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-m", "--model", required=True, help="Path of the saved forest",
+                        dest="model")
+    parser.add_argument("--host", required=False, default="127.0.0.1",
+                        help="Address on which the server listens", dest="host")
+    parser.add_argument("-p", "--port", required=False, type=int, default=8000,
+                        help="Port on which the server listens", dest="port")
+    parser.add_argument("-bs", "--batch-size", required=False, type=int, default=1000,
+                        help="Maximum number of instances classified at once", dest="max_batch_size")
+    parser.add_argument("-w", "--max-wait", required=False, type=float, default=5,
+                        help="Maximum time (in milliseconds) that a request waits for other requests before being classified",
+                        dest="max_wait")
+    args = parser.parse_args()
+
+    prediction_server = PredictionServer(load_forest(args.model), args.max_batch_size,
+                                         args.max_wait/1000)
+    try:
+        asyncio.run(prediction_server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -1,37 +1,102 @@
 import csv
-from random import sample
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from itertools import compress, islice
+from operator import itemgetter, not_
+from random import Random
 
-from dataset import Dataset
-from decision_tree import EndNode
+import instrumentation
+from dataset import Dataset, filter_dataset, Vocabulary
+from decision_tree import CompiledForest, EndNode
 
 
-def get_dataset(filename, target_name, training_fraction):
+# Version of the format of the dataset cache, to be increased whenever the format changes
+_CACHE_VERSION = 1
+# First bytes of the files that contain a forest
+_FOREST_MAGIC = b"CDTF"
+# Version of the format of the forest files, to be increased whenever the format changes
+_FOREST_VERSION = 2
+# Layout of the bytes that follow the magic: the version and the length of the JSON header
+_FOREST_PREAMBLE = struct.Struct("<II")
+# Arrays of a compiled forest (and their typecodes) stored in the forest files of each version, in
+# order (the arrays of doubles come first, so that every array is aligned to its item size)
+_FOREST_ARRAYS = {1: [("features", "i"), ("targets", "i"), ("children_offsets", "i"),
+                      ("children_counts", "i"), ("children", "i"), ("roots", "i")],
+                  2: [("gains", "d"), ("features", "i"), ("targets", "i"), ("children_offsets", "i"),
+                      ("children_counts", "i"), ("children", "i"), ("roots", "i"),
+                      ("instances_counts", "i")]}
+# Maximum number of values written on an edge of a graph, when several values share a child
+_MAX_EDGE_VALUES = 5
+# Table that turns the flags of the training instances (zero or one bytes) into the ones of the
+# test instances
+_NEGATED_FLAGS = bytes([1, 0]) + bytes(254)
+
+
+def get_dataset(filename, target_name, training_fraction, seed=None, chunk_size=10000, cache=True):
     """
-    Return a Dataset, using the data in the CSV file (Dataset)
+    Return a training Dataset and a test Dataset, using the data in the CSV file (Dataset, Dataset)
+
+    The file is read in chunks, and each instance is assigned to the training dataset with
+    probability training_fraction as soon as it is read, so the memory needed is the one of the
+    encoded datasets plus a single chunk. The two datasets share their vocabularies.
+
+    The encoded data is also stored in a binary cache next to the file, which is used instead of
+    the file as long as the file does not change. The columns of the cache are memory-mapped, so
+    the processes that load the same whole dataset share the same memory; when the instances are
+    split, the two datasets are copied out of the mapped columns, which only needs one more byte
+    for each instance.
 
     Parameters:
         - filename: name of the file that contains the data (String)
         - target_name: name of the target in the csv file
         - training_fraction: The fraction of records reserved for the training dataset (number)
+        - seed: the number used to initialize the random number generator that splits the records,
+          default to None (int)
+        - chunk_size: the number of records read at a time, default to 10000 (int)
+        - cache: whether the binary cache has to be used, default to True (bool)
     """
-    csv_reader = csv.DictReader(open(filename))
-    attributes_names = [attribute_name for attribute_name in csv_reader.fieldnames
-                        if attribute_name != target_name]
-    train_dataset = Dataset(attributes_names, target_name)
-    test_dataset = Dataset(attributes_names, target_name)
-    instances = []
-    for row in csv_reader:
-        instances.append(([row[attribute_name] for attribute_name in attributes_names],
-                          row[target_name]))
-    all_instances_indexes = set(range(0, len(instances)))
-    number_of_training_instances = int(len(all_instances_indexes) * training_fraction)
-    training_instances_indexes = set(sample(all_instances_indexes, number_of_training_instances))
-    test_instances_indexes = all_instances_indexes.difference(training_instances_indexes)
-    for instance_index in training_instances_indexes:
-        train_dataset.add_instance(instances[instance_index][0], instances[instance_index][1])
-    for instance_index in test_instances_indexes:
-        test_dataset.add_instance(instances[instance_index][0], instances[instance_index][1])
-    return train_dataset, test_dataset
+    if not cache:
+        with instrumentation.phase("read_csv"):
+            return _read_dataset(filename, target_name, training_fraction, seed, chunk_size)
+    with instrumentation.phase("load_cache"):
+        dataset = _load_cached_dataset(filename, target_name)
+    if dataset is None:
+        # The file is described as it was before being read, so that a change made while it is
+        # read makes the cache stale instead of wrong
+        source = os.stat(filename)
+        with instrumentation.phase("read_csv"):
+            dataset, _ = _read_dataset(filename, target_name, 1, None, chunk_size)
+        try:
+            with instrumentation.phase("save_cache"):
+                _save_cached_dataset(filename, dataset, source)
+        except OSError:
+            # The cache is an optimization: a read-only directory is not a reason to fail
+            pass
+        else:
+            # The dataset read from the file is kept if the cache has already been removed (for
+            # instance, by another process that is writing it)
+            cached_dataset = _load_cached_dataset(filename, target_name)
+            if cached_dataset is not None:
+                dataset = cached_dataset
+    # The instances are split with the same draws of _read_dataset, so the split does not depend on
+    # the cache
+    empty_dataset = Dataset(dataset.get_attributes_names(), target_name, dataset.vocabularies,
+                            dataset.get_target_vocabulary())
+    if training_fraction >= 1:
+        return dataset, empty_dataset
+    if training_fraction <= 0:
+        return empty_dataset, dataset
+    with instrumentation.phase("split_dataset"):
+        random_state = Random(seed)
+        # A byte for each instance, instead of the 8 bytes of a list item
+        training_flags = bytearray(random_state.random() < training_fraction
+                                   for _ in range(dataset.count_instances()))
+        return (filter_dataset(dataset, training_flags),
+                filter_dataset(dataset, training_flags.translate(_NEGATED_FLAGS)))
 
 def export_graphviz(filename, decision_tree):
     """
@@ -49,13 +114,265 @@ def export_graphviz(filename, decision_tree):
                                                             str(node.get_target_value())))
             return
         output.write("\t\"" + str(id(node)) + "\" [label=\"\"]\n")
-        for decision_attribute_value in node.children.keys():
+        for child, decision_attribute_values in node.get_children_groups():
+            # The values that share a child are drawn on a single edge
             output.write("\t\"{}\" -> \"{}\" [label=\"{}={}\"]\n".format(str(id(node)),
-                                                                         str(id(node.get_child(decision_attribute_value))),
+                                                                         str(id(child)),
                                                                          str(node.get_decision_attribute()),
-                                                                         str(decision_attribute_value)))
-            _export_node(node.get_child(decision_attribute_value), output)
+                                                                         _format_values(decision_attribute_values)))
+            _export_node(child, output)
     output = open(filename, 'w')
     output.write("digraph G {\n")
     _export_node(decision_tree, output)
     output.write("}")
+
+def save_forest(filename, forest):
+    """
+    Save the random forest in a binary file
+
+    The file contains a JSON header with the attributes names and the vocabularies of the forest,
+    followed by the flat arrays of the compiled forest, so it can be loaded without rebuilding a
+    single node.
+
+    Parameters:
+        - filename: name of the file where the forest has to be saved (String)
+        - forest: the random forest that has to be saved (List of DecisionNode or EndNode, or
+          CompiledForest)
+    """
+    if not isinstance(forest, CompiledForest):
+        decision_trees, forest = forest, CompiledForest()
+        for decision_tree in decision_trees:
+            forest.add_tree(decision_tree)
+    header = json.dumps({"byteorder": sys.byteorder,
+                         "attributes_names": forest.attributes_names,
+                         "vocabularies": [vocabulary.get_values() for vocabulary in forest.vocabularies],
+                         "target_vocabulary": forest.target_vocabulary.get_values(),
+                         "lengths": [len(getattr(forest, name))
+                                     for name, _ in _FOREST_ARRAYS[_FOREST_VERSION]]}).encode()
+    # The arrays start at a multiple of their item size, so they can be mapped in place
+    header += b" " * (-(len(_FOREST_MAGIC) + _FOREST_PREAMBLE.size + len(header)) % 8)
+    content = [_FOREST_MAGIC, _FOREST_PREAMBLE.pack(_FOREST_VERSION, len(header)), header]
+    content.extend(array(typecode, getattr(forest, name)).tobytes()
+                   for name, typecode in _FOREST_ARRAYS[_FOREST_VERSION])
+    _write_atomically(filename, b"".join(content))
+
+def load_forest(filename, memory_map=False):
+    """
+    Return the random forest saved in the binary file (CompiledForest)
+
+    Parameters:
+        - filename: name of the file where the forest has been saved (String)
+        - memory_map: whether the arrays of the forest have to be mapped in memory instead of
+          being read, default to False (a memory-mapped forest can not be extended) (bool)
+    """
+    with open(filename, "rb") as forest_file:
+        if memory_map:
+            content = memoryview(mmap.mmap(forest_file.fileno(), 0, access=mmap.ACCESS_READ))
+        else:
+            content = memoryview(forest_file.read())
+    offset = len(_FOREST_MAGIC) + _FOREST_PREAMBLE.size
+    if bytes(content[:len(_FOREST_MAGIC)]) != _FOREST_MAGIC:
+        raise ValueError("{} does not contain a forest".format(filename))
+    version, header_length = _FOREST_PREAMBLE.unpack(content[len(_FOREST_MAGIC):offset])
+    if version not in _FOREST_ARRAYS:
+        raise ValueError("Unsupported forest format version: {}".format(version))
+    header = json.loads(bytes(content[offset:offset + header_length]))
+    offset += header_length
+    forest = CompiledForest(header["attributes_names"],
+                            [Vocabulary(values) for values in header["vocabularies"]],
+                            Vocabulary(header["target_vocabulary"]))
+    for (name, typecode), length in zip(_FOREST_ARRAYS[version], header["lengths"]):
+        forest_array = array(typecode)
+        forest_bytes = content[offset:offset + forest_array.itemsize*length]
+        offset += forest_array.itemsize*length
+        if memory_map and header["byteorder"] == sys.byteorder:
+            setattr(forest, name, forest_bytes.cast(typecode))
+            continue
+        forest_array.frombytes(forest_bytes)
+        if header["byteorder"] != sys.byteorder:
+            forest_array.byteswap()
+        setattr(forest, name, forest_array)
+    # The arrays added by later versions are filled with zeros (unknown values)
+    loaded_names = {name for name, _ in _FOREST_ARRAYS[version]}
+    for name, typecode in _FOREST_ARRAYS[_FOREST_VERSION]:
+        if name not in loaded_names:
+            setattr(forest, name, array(typecode, [0])*forest.count_nodes())
+    return forest
+
+
+# PRIVATE FUNCTIONS
+# These functions should not be used outside the module
+def _read_dataset(filename, target_name, training_fraction, seed, chunk_size):
+    """
+    Return a training Dataset and a test Dataset, reading the CSV file in chunks (Dataset, Dataset)
+
+    Parameters:
+        - filename: name of the file that contains the data (String)
+        - target_name: name of the target in the csv file
+        - training_fraction: The fraction of records reserved for the training dataset (number)
+        - seed: the number used to initialize the random number generator that splits the records
+          (int)
+        - chunk_size: the number of records read at a time (int)
+    """
+    random_state = Random(seed)
+    with open(filename, newline="") as csv_file:
+        csv_reader = csv.reader(csv_file)
+        fieldnames = next(csv_reader)
+        attributes_names = [attribute_name for attribute_name in fieldnames
+                            if attribute_name != target_name]
+        attributes_getters = [itemgetter(fieldnames.index(attribute_name))
+                              for attribute_name in attributes_names]
+        target_getter = itemgetter(fieldnames.index(target_name))
+        vocabularies = [Vocabulary() for _ in attributes_names]
+        target_vocabulary = Vocabulary()
+        train_dataset = Dataset(attributes_names, target_name, vocabularies, target_vocabulary)
+        test_dataset = Dataset(attributes_names, target_name, vocabularies, target_vocabulary)
+        records = _read_records(csv_reader, len(fieldnames), filename)
+        while True:
+            rows = list(islice(records, chunk_size))
+            if not rows:
+                break
+            if training_fraction >= 1:
+                training_flags = [True] * len(rows)
+            else:
+                training_flags = [random_state.random() < training_fraction for _ in rows]
+            for dataset, flags in [(train_dataset, training_flags),
+                                   (test_dataset, list(map(not_, training_flags)))]:
+                dataset_rows = list(compress(rows, flags))
+                dataset.extend_columns([map(attribute_getter, dataset_rows)
+                                        for attribute_getter in attributes_getters],
+                                       map(target_getter, dataset_rows))
+    return train_dataset, test_dataset
+
+def _read_records(csv_reader, n_of_fields, filename):
+    """
+    Return an iterator over the records of a CSV file, skipping the empty lines (iterator of lists
+    of Strings)
+
+    Parameters:
+        - csv_reader: the reader of the file, after the header (csv.reader)
+        - n_of_fields: the number of fields of the header (int)
+        - filename: name of the file, used in the error messages (String)
+    """
+    for row in csv_reader:
+        if not row:
+            continue
+        if len(row) != n_of_fields:
+            raise ValueError("Line {} of {} has {} fields instead of {}".format(
+                csv_reader.line_num, filename, len(row), n_of_fields))
+        yield row
+
+def _get_cache_directory(filename):
+    """
+    Return the directory of the binary cache of the CSV file (String)
+
+    Parameters:
+        - filename: name of the file that contains the data (String)
+    """
+    return filename + ".cache"
+
+def _load_cached_dataset(filename, target_name):
+    """
+    Return the Dataset stored in the binary cache of the CSV file, None if the cache does not exist
+    or if it is older than the file (Dataset)
+
+    Parameters:
+        - filename: name of the file that contains the data (String)
+        - target_name: name of the target in the csv file
+    """
+    cache_directory = _get_cache_directory(filename)
+    try:
+        with open(os.path.join(cache_directory, "header.json")) as header_file:
+            header = json.load(header_file)
+        source = os.stat(filename)
+    except (OSError, ValueError):
+        return None
+    if (header.get("version") != _CACHE_VERSION or header["byteorder"] != sys.byteorder
+            or header["source_size"] != source.st_size
+            or header["source_mtime_ns"] != source.st_mtime_ns
+            or header["target_name"] != target_name):
+        return None
+    dataset = Dataset(header["attributes_names"], target_name,
+                      [Vocabulary(values) for values in header["vocabularies"]],
+                      Vocabulary(header["target_vocabulary"]))
+    try:
+        dataset.columns = [_map_column(os.path.join(cache_directory, "attribute{}.bin".format(index)),
+                                       typecode)
+                           for index, typecode in enumerate(header["typecodes"])]
+        dataset.target = _map_column(os.path.join(cache_directory, "target.bin"),
+                                     header["target_typecode"])
+    except (OSError, ValueError):
+        return None
+    return dataset
+
+def _save_cached_dataset(filename, dataset, source):
+    """
+    Store the Dataset in the binary cache of the CSV file
+
+    The header, which makes the cache valid, is written last, so an interrupted write leaves no
+    valid cache behind.
+
+    Parameters:
+        - filename: name of the file that contains the data (String)
+        - dataset: the dataset read from the file (Dataset)
+        - source: the status of the file before it was read (os.stat_result)
+    """
+    cache_directory = _get_cache_directory(filename)
+    os.makedirs(cache_directory, exist_ok=True)
+    header_filename = os.path.join(cache_directory, "header.json")
+    if os.path.exists(header_filename):
+        os.remove(header_filename)
+    columns = [("attribute{}.bin".format(index), column) for index, column in enumerate(dataset.columns)]
+    for column_filename, column in columns + [("target.bin", dataset.get_target_column())]:
+        _write_atomically(os.path.join(cache_directory, column_filename), column.tobytes())
+    header = {"version": _CACHE_VERSION,
+              "byteorder": sys.byteorder,
+              "source_size": source.st_size,
+              "source_mtime_ns": source.st_mtime_ns,
+              "target_name": dataset.get_target_name(),
+              "attributes_names": dataset.get_attributes_names(),
+              "vocabularies": [vocabulary.get_values() for vocabulary in dataset.vocabularies],
+              "target_vocabulary": dataset.get_target_vocabulary().get_values(),
+              "typecodes": [column.typecode for column in dataset.columns],
+              "target_typecode": dataset.get_target_column().typecode}
+    _write_atomically(header_filename, json.dumps(header).encode())
+
+def _write_atomically(filename, content):
+    """
+    Write the content in the file, replacing it only once the content has been fully written
+
+    Parameters:
+        - filename: name of the file (String)
+        - content: the content of the file (bytes)
+    """
+    temporary_filename = "{}.{}.tmp".format(filename, os.getpid())
+    with open(temporary_filename, "wb") as temporary_file:
+        temporary_file.write(content)
+    os.replace(temporary_filename, filename)
+
+def _map_column(filename, typecode):
+    """
+    Return the column stored in the file, mapped in memory in read-only mode (memoryview of ints)
+
+    Parameters:
+        - filename: name of the file that contains the column (String)
+        - typecode: the typecode of the codes of the column (String)
+    """
+    with open(filename, "rb") as column_file:
+        if os.fstat(column_file.fileno()).st_size == 0:
+            # Empty files cannot be mapped
+            return array(typecode)
+        return memoryview(mmap.mmap(column_file.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
+
+def _format_values(values):
+    """
+    Return the label of an edge associated to one or more attribute values, shortened if there are
+    too many values (String)
+
+    Parameters:
+        - values: the attribute values (list of values)
+    """
+    label = "|".join(str(value) for value in values[:_MAX_EDGE_VALUES])
+    if len(values) > _MAX_EDGE_VALUES:
+        label += "|... ({} more)".format(len(values) - _MAX_EDGE_VALUES)
+    return label